@@ -50,7 +50,8 @@ for item in tqdm(data["questions"], desc="Processing Questions", unit="question"
         9.
         """
 
-        response = ai_call.template(question_augment_prompt)
+        # 重試時略過快取，避免重複取回格式錯誤的回應
+        response = ai_call.template(question_augment_prompt, refresh=retries > 0)
         augmented_queries = response.strip().split("\n")
         
         # 去除前綴數字標號（例如 "1. "、"2. "）
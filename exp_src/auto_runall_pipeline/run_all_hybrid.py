@@ -1,11 +1,70 @@
+import os
+import sys
+import json
+import argparse
 import subprocess
+import concurrent.futures
+from datetime import datetime
 
-def run_ir_autotest(alpha_list):
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+def run_ir_autotest(alpha_list, workers=8, batch_size=16):
     for alpha in alpha_list:
-        command = ["python3", "exp_src/ir_autotest_hybrid.py", "--alpha", str(alpha)]
+        command = ["python3", "exp_src/ir_autotest_hybrid.py", "--alpha", str(alpha), "--workers", str(workers), "--batch-size", str(batch_size)]
         print(f"Running: {' '.join(command)}")
         subprocess.run(command, check=True)
 
+def run_sweep(alpha_list, refresh=False, workers=8, batch_size=16):
+    """每個 (task, 問題) 只檢索一次，再以快取的分數計算整個 alpha grid"""
+    import matplotlib.pyplot as plt
+    import ir_autotest_hybrid as ir
+    from utils.query_store import QueryStore, QUERY_STORE_DIR
+    from utils.query_batcher import QueryBatcher
+
+    query_store = QueryStore.load_or_build(ir.questions, QUERY_STORE_DIR, os.environ['OPENAI_API_KEY'])
+    client = ir.get_client(max(ir.POOL_SIZE, workers * len(ir.tasks) * 2))
+    batcher = QueryBatcher(client, batch_size) if batch_size > 1 else None
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ir.tasks)) as executor:
+        futures = [executor.submit(ir.sweep_task, task, alpha_list, query_store, refresh, workers, batcher) for task in ir.tasks]
+        for future in concurrent.futures.as_completed(futures):
+            task, metrics = future.result()
+            results[task] = metrics
+    if batcher is not None:
+        batcher.close()
+        print(batcher.report())
+
+    today = datetime.today().strftime("%m%d")
+    with open(f"result/alpha_sweep_{today}.json", 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    for metric in ('AP@1', 'MRR'):
+        plt.figure(figsize=(10, 6))
+        for task in ir.tasks:
+            plt.plot(alpha_list, [results[task][alpha][metric] for alpha in alpha_list], label=task)
+        plt.xlabel('alpha')
+        plt.ylabel(metric)
+        plt.title(f'{metric} vs. alpha')
+        plt.ylim(0, 1)
+        plt.legend()
+        plt.savefig(f"result/{metric.replace('@', '').lower()}_alpha_sweep_{today}.png", dpi=300, bbox_inches='tight')
+
+    for task in ir.tasks:
+        best = max(alpha_list, key=lambda alpha: results[task][alpha]['AP@1'])
+        print(f"{task}: best alpha {best:.2f} (AP@1 {results[task][best]['AP@1']:.2%}, MRR {results[task][best]['MRR']:.2%})")
+
 if __name__ == "__main__":
-    alpha_list = [1.0, 0.5, 0.0]
-    run_ir_autotest(alpha_list)
+    parser = argparse.ArgumentParser(description="Hybrid retrieval experiments")
+    parser.add_argument("--sweep", action="store_true", help="Retrieve once per (task, question) and evaluate a whole alpha grid")
+    parser.add_argument("--steps", type=int, default=51, help="Number of evenly spaced alphas in [0, 1] for --sweep")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached candidate lists and query Weaviate again")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent questions per task")
+    parser.add_argument("--batch-size", type=int, default=16, help="Get blocks packed into one GraphQL request (1 disables batching)")
+    args = parser.parse_args()
+
+    if args.sweep:
+        steps = max(args.steps, 2)
+        run_sweep([i / (steps - 1) for i in range(steps)], args.refresh, args.workers, args.batch_size)
+    else:
+        alpha_list = [1.0, 0.5, 0.0]
+        run_ir_autotest(alpha_list, args.workers, args.batch_size)
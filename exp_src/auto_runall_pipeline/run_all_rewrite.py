@@ -5,16 +5,9 @@ def run_task(command, log_file):
         process = subprocess.Popen(command, stdout=f, stderr=f, shell=True)
     return process
 
-task2 = run_task("python3 exp_src/rewrite.py --task Ourswomllm", "logs/ourswomllm.log")
-task3 = run_task("python3 exp_src/rewrite.py --task Ourswoocr", "logs/ourswoocr.log")
+# 單次掃描語料即產生所有變體：每頁只讀取一次，並同時送往各個 Claude 變體
+final_task = run_task("python3 exp_src/rewrite.py --tasks Ourswomllm,Ourswoocr,Oursworewrite,Ours --workers 4", "logs/rewrite_all.log")
 
-task2.wait()
-task3.wait()
-
-task4 = run_task("python3 exp_src/rewrite.py --task Oursworewrite", "logs/oursworewrite.log")
-final_task = run_task("python3 exp_src/rewrite.py --task Ours", "logs/ours.log")
-
-task4.wait()
 final_task.wait()
 
 print("All tasks completed.")
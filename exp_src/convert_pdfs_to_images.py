@@ -1,11 +1,15 @@
 import os
+import argparse
+import tempfile
+import concurrent.futures
 from tqdm import tqdm
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from utils.manifest import CorpusManifest
 
 PDF_DIR = "data/esun_dataset/reference/finance_source"
 IMG_DIR = "data/esun_dataset/reference/finance_source_img"
 
-def pdf_to_images(pdf_dir, img_dir):
+def pdf_to_images(pdf_dir, img_dir, manifest=None):
     os.makedirs(img_dir, exist_ok=True)
     pdf_files = [f for f in os.listdir(pdf_dir) if f.endswith(".pdf")]
     
@@ -13,6 +17,9 @@ def pdf_to_images(pdf_dir, img_dir):
         pdf_path = os.path.join(pdf_dir, filename)
         pdf_name = os.path.splitext(filename)[0]
         pdf_output_dir = os.path.join(img_dir, pdf_name)
+
+        if manifest is not None and manifest.is_current(pdf_name, "images"):
+            continue
         
         os.makedirs(pdf_output_dir, exist_ok=True)
         
@@ -22,6 +29,178 @@ def pdf_to_images(pdf_dir, img_dir):
             img_path = os.path.join(pdf_output_dir, f"{i}.png")
             image.save(img_path, "PNG")
 
+        if manifest is not None:
+            remove_stale_pages(pdf_output_dir, len(images))
+            manifest.set_pages(pdf_name, len(images))
+            manifest.mark(pdf_name, "images")
+
+def remove_stale_pages(pdf_output_dir, total_pages):
+    """Delete page PNGs beyond `total_pages`, left over from a longer earlier version of the PDF."""
+    for image_file in os.listdir(pdf_output_dir):
+        page, ext = os.path.splitext(image_file)
+        if ext == ".png" and page.isdigit() and int(page) > total_pages:
+            os.remove(os.path.join(pdf_output_dir, image_file))
+
+def is_page_up_to_date(pdf_path, img_path):
+    """A page is skipped when its PNG exists and is newer than the source PDF."""
+    return os.path.exists(img_path) and os.path.getmtime(img_path) >= os.path.getmtime(pdf_path)
+
+def page_runs(pages):
+    """Group ascending page numbers into (first_page, last_page) runs of consecutive pages."""
+    runs = []
+    for page in pages:
+        if runs and page == runs[-1][1] + 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return [tuple(run) for run in runs]
+
+def render_pages(pdf_path, first_page, last_page, output_folder):
+    """
+    Render pages [first_page, last_page] with a single pdftoppm call; returns {page: png_path}.
+
+    Frames are written to `output_folder` as pdftoppm produces them, so no page image is
+    held in memory and the PDF is parsed once per call instead of once per page.
+    """
+    paths = convert_from_path(
+        pdf_path, first_page=first_page, last_page=last_page,
+        output_folder=output_folder, fmt="png", paths_only=True,
+    )
+    return dict(zip(range(first_page, last_page + 1), paths))
+
+def render_page_range(pdf_path, pdf_output_dir, first_page, last_page, force=False):
+    """
+    Render pages [first_page, last_page] of one PDF with one pdftoppm call per run of stale pages.
+
+    Returns the number of pages actually rendered (pages that are already up to date are
+    skipped unless `force`).
+    """
+    stale_pages = [
+        page for page in range(first_page, last_page + 1)
+        if force or not is_page_up_to_date(pdf_path, os.path.join(pdf_output_dir, f"{page}.png"))
+    ]
+    if not stale_pages:
+        return 0
+
+    # 先渲染到暫存子資料夾再改名，避免中斷時留下殘缺的 {page}.png 被當成已完成
+    with tempfile.TemporaryDirectory(prefix=".render-", dir=pdf_output_dir) as tmp_dir:
+        for run_first, run_last in page_runs(stale_pages):
+            for page, path in render_pages(pdf_path, run_first, run_last, tmp_dir).items():
+                os.replace(path, os.path.join(pdf_output_dir, f"{page}.png"))
+    return len(stale_pages)
+
+def iter_pdf_pages(pdf_path, save_dir=None, skip_pages=(), pages_per_call=8):
+    """
+    Yield (page_number, png_bytes) for each page of a PDF.
+
+    Pages are rendered `pages_per_call` at a time by pdftoppm into a temporary folder and
+    read back one by one; they are only kept in `save_dir` as `{page}.png` when given.
+    Pages listed in `skip_pages` are not rendered.
+    """
+    total_pages = pdfinfo_from_path(pdf_path)["Pages"]
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+
+    pages = [page for page in range(1, total_pages + 1) if page not in skip_pages]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for run_first, run_last in page_runs(pages):
+            for first_page in range(run_first, run_last + 1, pages_per_call):
+                last_page = min(first_page + pages_per_call - 1, run_last)
+                for page, path in render_pages(pdf_path, first_page, last_page, tmp_dir).items():
+                    with open(path, "rb") as img_file:
+                        image_bytes = img_file.read()
+                    os.remove(path)
+
+                    if save_dir:
+                        with open(os.path.join(save_dir, f"{page}.png"), "wb") as img_file:
+                            img_file.write(image_bytes)
+
+                    yield page, image_bytes
+
+def plan_page_jobs(pdf_dir, img_dir, pages_per_job, manifest=None):
+    """
+    Split every PDF into page-range jobs: (pdf_path, pdf_output_dir, first_page, last_page, force).
+
+    With a manifest only new or changed PDFs are planned and all their pages are re-rendered
+    (`force`), since the mtime of a replaced PDF need not be newer than its old PNGs;
+    without one, pages whose PNG is newer than the PDF are skipped.
+    """
+    jobs = []
+    pdf_files = [f for f in os.listdir(pdf_dir) if f.endswith(".pdf")]
+    for filename in tqdm(pdf_files, desc="Planning PDF Jobs"):
+        pdf_path = os.path.join(pdf_dir, filename)
+        pdf_name = os.path.splitext(filename)[0]
+        pdf_output_dir = os.path.join(img_dir, pdf_name)
+        if manifest is not None and manifest.is_current(pdf_name, "images"):
+            continue
+        os.makedirs(pdf_output_dir, exist_ok=True)
+
+        total_pages = pdfinfo_from_path(pdf_path)["Pages"]
+        if manifest is not None:
+            remove_stale_pages(pdf_output_dir, total_pages)
+            manifest.set_pages(pdf_name, total_pages)
+        for first_page in range(1, total_pages + 1, pages_per_job):
+            last_page = min(first_page + pages_per_job - 1, total_pages)
+            jobs.append((pdf_path, pdf_output_dir, first_page, last_page, manifest is not None))
+    return jobs
+
+def pdf_to_images_parallel(pdf_dir, img_dir, workers=None, pages_per_job=8, manifest=None):
+    """
+    Fan PDFs and page ranges out across a process pool.
+
+    Each job renders its page range with one pdftoppm call that writes frames straight to
+    disk, so memory stays bounded regardless of the PDF length. Without a manifest, pages
+    whose PNG is newer than the source PDF are skipped.
+    """
+    os.makedirs(img_dir, exist_ok=True)
+    jobs = plan_page_jobs(pdf_dir, img_dir, pages_per_job, manifest)
+    total_pages = sum(last - first + 1 for _, _, first, last, _ in jobs)
+
+    # 每份 PDF 的所有 job 皆成功後才在 manifest 標記為已完成
+    remaining_jobs = {}
+    for pdf_path, _, _, _, _ in jobs:
+        remaining_jobs[pdf_path] = remaining_jobs.get(pdf_path, 0) + 1
+    failed_pdfs = set()
+
+    rendered = 0
+    progress_bar = tqdm(total=total_pages, desc="Converting PDFs to Images", unit="page")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        future_to_job = {executor.submit(render_page_range, *job): job for job in jobs}
+        for future in concurrent.futures.as_completed(future_to_job):
+            pdf_path, _, first_page, last_page, _ = future_to_job[future]
+            try:
+                rendered += future.result()
+            except Exception as e:
+                print(f'for "{pdf_path}" pages {first_page}-{last_page} Unexpected error: {str(e)}')
+                failed_pdfs.add(pdf_path)
+            progress_bar.update(last_page - first_page + 1)
+
+            remaining_jobs[pdf_path] -= 1
+            if manifest is not None and remaining_jobs[pdf_path] == 0 and pdf_path not in failed_pdfs:
+                manifest.mark(os.path.splitext(os.path.basename(pdf_path))[0], "images")
+    progress_bar.close()
+    return rendered
+
 if __name__ == "__main__":
-    pdf_to_images(PDF_DIR, IMG_DIR)
+    parser = argparse.ArgumentParser(description="Convert PDFs to PNG images")
+    parser.add_argument("--workers", type=int, default=0, help="Process pool size; 0 keeps the sequential converter")
+    parser.add_argument("--pages-per-job", type=int, default=8, help="Pages rendered per pool job")
+    parser.add_argument("--incremental", action="store_true", help="Only convert PDFs that are new or changed according to the corpus manifest")
+    args = parser.parse_args()
+
+    manifest = None
+    if args.incremental:
+        manifest = CorpusManifest()
+        changed = manifest.refresh(PDF_DIR)
+        print(f"{len(changed)} new or changed PDFs")
+
+    try:
+        if args.workers > 0:
+            rendered = pdf_to_images_parallel(PDF_DIR, IMG_DIR, args.workers, args.pages_per_job, manifest)
+            print(f"Rendered {rendered} pages")
+        else:
+            pdf_to_images(PDF_DIR, IMG_DIR, manifest)
+    finally:
+        if manifest is not None:
+            manifest.save()
     print(f"Images saved in: {IMG_DIR}")
@@ -3,17 +3,24 @@ import weaviate
 import warnings
 import time
 import uuid
+import hashlib
 import sys
 import os
 import argparse
+import queue
+import threading
+import itertools
+import concurrent.futures
 from tqdm import tqdm
-import jieba
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 import utils.config_log as config_log
 import weaviate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from utils.manifest import CorpusManifest, file_sha256
+from utils.ai.embedding_cache import BatchEmbedder
+import utils.tokenizer as tokenizer
+from utils.chunker import TokenChunker
 
 # 讀取設定檔與初始化日誌
 config, logger, CONFIG_PATH = config_log.setup_config_and_logging()
@@ -27,29 +34,88 @@ openai_api_key = config.get('OpenAI', 'api_key')
 # 忽略所有的 DeprecationWarning
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+# batch import 的初始與最大批次大小（依結果動態調整）
+BATCH_SIZE = 100
+MAX_BATCH_SIZE = 1000
+
+# 以 batch delete 刪除舊 chunk 時，每次請求的 uuid 數
+DELETE_BATCH_SIZE = 500
+
+# pipeline 各 stage 之間 queue 的容量（chunk 數）
+QUEUE_SIZE = 1000
+_DONE = object()
+
+
+class PipelineStopped(RuntimeError):
+    """另一個 stage 失敗後，其餘 stage 中止時拋出"""
+
+
+def init_tokenizer():
+    """Process pool initializer：fork 時沿用主程序已載入的字典，否則由快取載入"""
+    tokenizer.get_tokenizer()
+
+
+def tokenize_chunk(chunk_text):
+    """以 jieba 斷詞並以空白串接，作為 BM25 class 的內容"""
+    return tokenizer.tokenize(chunk_text)
+
+
+def chunk_uuid(task, pid, index, content):
+    """由 task、pid、chunk 序號與內容雜湊決定的固定 uuid，重新執行時同一 chunk 得到相同 id"""
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{task}/{pid}/{index}/{content_hash}"))
+
+
+def classify_error(error_msg):
+    """將 Weaviate 錯誤訊息分類為 'TOO_LONG'、'RETRY'（429 / 500 / 逾時）或 False"""
+    if 'maximum context length' in error_msg:
+        return 'TOO_LONG'
+    if '429' in error_msg or '500' in error_msg or 'rate limit' in error_msg.lower() or 'timed out' in error_msg.lower():
+        return 'RETRY'
+    return False
+
 
 class WeaviateManager:
     """Weaviate 資料插入管理器"""
 
-    def __init__(self, classnm):
-        """初始化 Weaviate 連線，並檢查或建立 class"""
+    def __init__(self, classnm, keyword=False):
+        """
+        初始化 Weaviate 連線，並檢查或建立 class。
+        keyword=True 為 BM25 用的 `{task}_key` class：content 是 jieba 斷詞後以空白串接的文字，
+        token 數比原 chunk 多，且只用於 BM25（查詢時 alpha=0），因此不送去向量化。
+        """
         self.url = wea_url
         self.client = weaviate.Client(url=wea_url, additional_headers={'X-OpenAI-Api-Key': openai_api_key})
         self.classnm = classnm
+        self.keyword = keyword
         self.check_class_exist()
 
     def check_class_exist(self):
         """檢查指定的 class 是否存在；若不存在則建立之"""
+        # 向量 class 只以 content 向量化（不含 class 名稱、uuid 與 pid），
+        # 與 --client-embed 在 client 端送出的輸入相同，兩種模式的向量可以混用
+        self.legacy_vectors = False
         if self.client.schema.exists(self.classnm):
+            if self.keyword and not self.content_skipped():
+                print(f'Warning: {self.classnm} vectorizes its tokenized content, which can exceed the embedding context; '
+                      f'run with --recreate to create it with the current schema')
+            if not self.keyword and not self.content_only():
+                self.legacy_vectors = True
+                print(f'Warning: {self.classnm} vectorizes its class name, uuid and pid along with content; '
+                      f'run with --recreate to re-embed it from content only')
             print(f'{self.classnm} is ready')
             return True
 
+        skip = {'text2vec-openai': {'skip': True}}
+        content_property = {'name': 'content', 'dataType': ['text']}
+        if self.keyword:
+            content_property['moduleConfig'] = skip
         schema = {
             'class': self.classnm,
             'properties': [
                 {'name': 'uuid', 'dataType': ['text']},
                 {'name': 'pid', 'dataType': ['text']},
-                {'name': 'content', 'dataType': ['text']},
+                content_property,
             ],
             'vectorizer': 'text2vec-openai',
             'moduleConfig': {
@@ -60,14 +126,77 @@ class WeaviateManager:
                 }
             },
         }
+        if not self.keyword:
+            schema['moduleConfig']['text2vec-openai']['vectorizeClassName'] = False
+            for prop in schema['properties'][:2]:
+                prop['moduleConfig'] = skip
         print(f'Creating class: {self.classnm} ...')
         self.client.schema.create_class(schema)
         print(f'{self.classnm} is ready')
         return True
 
+    def module_config(self, prop_name=None):
+        """既有 class（或其屬性）的 text2vec-openai 設定"""
+        class_schema = self.client.schema.get(self.classnm)
+        if prop_name is None:
+            return (class_schema.get('moduleConfig') or {}).get('text2vec-openai', {})
+        for prop in class_schema.get('properties', []):
+            if prop['name'] == prop_name:
+                return (prop.get('moduleConfig') or {}).get('text2vec-openai', {})
+        return {}
+
+    def content_skipped(self):
+        """既有 class 的 content 屬性是否已設定為不向量化"""
+        return bool(self.module_config('content').get('skip'))
+
+    def content_only(self):
+        """既有 class 是否只以 content 向量化"""
+        return (
+            self.module_config().get('vectorizeClassName') is False
+            and all(self.module_config(name).get('skip') for name in ('uuid', 'pid'))
+        )
+
     def delete_class(self):
         self.client.schema.delete_class(self.classnm)
 
+    def delete_pid(self, pid):
+        """刪除指定 pid 的所有既有物件（文件已移除時使用）"""
+        self.client.batch.delete_objects(
+            class_name=self.classnm,
+            where={'path': ['pid'], 'operator': 'Equal', 'valueText': pid},
+        )
+
+    def delete_ids(self, object_uuids, batch_size=DELETE_BATCH_SIZE):
+        """以 batch delete 刪除指定 uuid 的物件（已不存在於文件中的舊 chunk），每次請求 batch_size 筆"""
+        object_uuids = list(object_uuids)
+        for start in range(0, len(object_uuids), batch_size):
+            part = object_uuids[start:start + batch_size]
+            try:
+                self.client.batch.delete_objects(
+                    class_name=self.classnm,
+                    where={'path': ['id'], 'operator': 'ContainsAny', 'valueTextArray': part},
+                )
+            except Exception as e:
+                print(f'Error deleting {len(part)} objects, class: {self.classnm} - {str(e)}')
+
+    def existing_ids(self, page_size=1000):
+        """以 cursor API 讀出 class 中所有物件的 {uuid: pid}"""
+        ids = {}
+        after = None
+        while True:
+            query = self.client.query.get(self.classnm, ['pid']).with_additional(['id']).with_limit(page_size)
+            if after is not None:
+                query = query.with_after(after)
+            result = query.do()
+            if 'errors' in result:
+                raise Exception(result['errors'][0]['message'])
+            objects = result['data']['Get'][self.classnm]
+            if not objects:
+                return ids
+            for obj in objects:
+                ids[obj['_additional']['id']] = obj['pid']
+            after = objects[-1]['_additional']['id']
+
     def insert_data(self, pid, content):
         """
         將資料插入 Weaviate。
@@ -106,13 +235,272 @@ class WeaviateManager:
         print(f'Failed to insert data for pid: {pid} after {max_retries} attempts.')
         return False
 
+    def _send_batch(self, batch_objects, embedder=None):
+        """
+        送出一批 (uuid, data_object)，回傳每筆物件的錯誤訊息（成功為 None）。
+        有 embedder 時於 client 端計算向量並一併送出，Weaviate 不再逐筆向量化；
+        向量只由 content 計算，與 class 設定的 server 端向量化輸入相同。
+        """
+        vectors = [None] * len(batch_objects)
+        if embedder is not None:
+            vectors = embedder.embed([data_object['content'] for _, data_object in batch_objects])
+        for (object_uuid, data_object), vector in zip(batch_objects, vectors):
+            self.client.batch.add_data_object(data_object, self.classnm, uuid=object_uuid, vector=vector)
+        try:
+            response = self.client.batch.create_objects()
+        except Exception:
+            # 整批請求失敗時清空暫存，避免下次送出時重複
+            self.client.batch.empty_objects()
+            raise
+
+        errors = {}
+        for item in response or []:
+            item_errors = (item.get('result') or {}).get('errors')
+            if item_errors:
+                errors[item['id']] = '; '.join(e.get('message', '') for e in item_errors.get('error', []))
+        return [errors.get(object_uuid) for object_uuid, _ in batch_objects]
+
+    def _insert_window(self, objects, size, max_batch_size, max_retries, embedder, progress):
+        """插入一個 window 的 (pid, content[, uuid])，回傳 (結果 list, 調整後的批次大小)"""
+        results = [False] * len(objects)
+        object_uuids = [obj[2] if len(obj) > 2 else str(uuid.uuid4()) for obj in objects]
+        data_objects = [
+            (object_uuid, {'uuid': object_uuid, 'pid': obj[0], 'content': obj[1]})
+            for object_uuid, obj in zip(object_uuids, objects)
+        ]
+
+        pending = list(range(len(objects)))
+        for attempt in range(max_retries):
+            retry = []
+            position = 0
+            while position < len(pending):
+                indices = pending[position:position + size]
+                position += len(indices)
+                try:
+                    errors = self._send_batch([data_objects[i] for i in indices], embedder)
+                except Exception as e:
+                    error_msg = str(e)
+                    errors = [error_msg] * len(indices)
+
+                throttled = False
+                for i, error_msg in zip(indices, errors):
+                    if error_msg is None:
+                        results[i] = True
+                        progress.update(1)
+                        continue
+                    status = classify_error(error_msg)
+                    if status == 'RETRY':
+                        throttled = True
+                        retry.append(i)
+                        continue
+                    if status == 'TOO_LONG':
+                        print(f'Content too long for pid: {objects[i][0]}, class: {self.classnm}')
+                    else:
+                        print(f'Error inserting data for pid: {objects[i][0]}, class: {self.classnm} - {error_msg}')
+                    results[i] = status
+                    progress.update(1)
+
+                size = max(1, size // 2) if throttled else min(max_batch_size, size * 2)
+
+            pending = retry
+            if not pending or attempt == max_retries - 1:
+                break
+            wait = min(60, 5 * 2 ** attempt)
+            print(f'{len(pending)} objects failed with retryable errors, retrying in {wait} seconds... (Attempt {attempt + 1}/{max_retries})')
+            time.sleep(wait)
+
+        if pending:
+            print(f'Failed to insert {len(pending)} objects into {self.classnm} after {max_retries} attempts.')
+            progress.update(len(pending))
+        return results, size
+
+    def insert_batch(self, objects, batch_size=BATCH_SIZE, max_batch_size=MAX_BATCH_SIZE, max_retries=5, embedder=None, window=MAX_BATCH_SIZE):
+        """
+        以 batch import 插入多筆 (pid, content)，回傳與 objects 等長的結果 list。
+        每筆結果與 insert_data 相同：True、'TOO_LONG' 或 False。
+          - 可附上第三個元素指定 uuid；已存在的 uuid 會被覆寫（upsert）
+          - objects 可為 list 或 generator，每次只讀入 window 筆，可邊產生邊插入
+          - 批次大小動態調整：出現 429 / 500 / 逾時時減半，整批成功時加倍
+          - 只重送可重試的失敗物件（沿用相同 uuid），並以指數退避等待
+          - 指定 embedder 時改以預先計算（並快取）的向量插入
+        """
+        results = []
+        size = batch_size
+        total = len(objects) if hasattr(objects, '__len__') else None
+        progress = tqdm(total=total, desc=f"Inserting {self.classnm}")
+        iterator = iter(objects)
+        while True:
+            window_objects = list(itertools.islice(iterator, window))
+            if not window_objects:
+                break
+            window_results, size = self._insert_window(window_objects, size, max_batch_size, max_retries, embedder, progress)
+            results.extend(window_results)
+        progress.close()
+        return results
+
+
+class StageCounter:
+    """Pipeline stage 的處理筆數與吞吐量"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def add(self, n=1):
+        with self.lock:
+            self.count += n
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        return f"{self.name}: {self.count} items, {self.count / elapsed if elapsed else 0:.1f} items/s"
+
+
+class IngestPipeline:
+    """
+    串流式 chunk -> tokenize -> insert pipeline。
+
+    檔案逐一讀取並切塊，chunk 直接送往向量 class 插入，同時交由 process pool 斷詞後
+    送往 keyword class 插入。各 stage 之間以有限容量的 queue 連接，下游較慢時上游自動
+    阻塞，記憶體不隨語料大小成長，切塊、斷詞（CPU）與插入（網路）同時進行。
+
+    每個 chunk 的 uuid 由 chunk_uuid 決定：已存在於 class 中的 chunk 直接略過（不再向量化），
+    內容變更的 chunk 以新 uuid 插入，舊 uuid 於結束後刪除。
+    """
+
+    def __init__(self, manager, managerkey, text_splitter, tokenizer_pool, embedder=None, queue_size=QUEUE_SIZE, existing=None, existing_key=None):
+        self.manager = manager
+        self.managerkey = managerkey
+        self.text_splitter = text_splitter
+        self.tokenizer_pool = tokenizer_pool
+        self.embedder = embedder
+        self.vector_queue = queue.Queue(maxsize=queue_size)
+        self.keyword_queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.existing = existing if existing is not None else {}
+        self.existing_key = existing_key if existing_key is not None else {}
+        self.chunk_ids = set()
+        self.counters = {
+            name: StageCounter(name)
+            for name in ("files", "chunks", "skipped", "tokenized", manager.classnm, managerkey.classnm)
+        }
+
+    def _put(self, target_queue, item):
+        """放入 queue；其他 stage 已中止時不再等待"""
+        while True:
+            try:
+                target_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if self.stopped.is_set():
+                    raise PipelineStopped("Ingest pipeline stopped by a failed stage")
+
+    def _iter_queue(self, source_queue, counter):
+        """依序取出 queue 中的物件直到 _DONE；其他 stage 已中止時不再等待 sentinel"""
+        while True:
+            if self.stopped.is_set():
+                raise PipelineStopped("Ingest pipeline stopped by a failed stage")
+            try:
+                item = source_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            counter.add()
+            yield item
+
+    def iter_chunks(self, directory, txt_files):
+        """逐檔讀取並切塊，依序產生 (pid, chunk_text, uuid)"""
+        for filename in tqdm(txt_files, desc="Preprocessing Files"):
+            pid = os.path.splitext(filename)[0]
+            with open(os.path.join(directory, filename), encoding='utf-8') as file:
+                content = file.read()
+            for index, chunk_text in enumerate(self.text_splitter.split_text(content)):
+                yield pid, chunk_text, chunk_uuid(self.manager.classnm, pid, index, chunk_text)
+            self.counters["files"].add()
+
+    def produce(self, directory, txt_files):
+        try:
+            for pid, chunk_text, object_uuid in self.iter_chunks(directory, txt_files):
+                self.counters["chunks"].add()
+                self.chunk_ids.add(object_uuid)
+                if object_uuid in self.existing and object_uuid in self.existing_key:
+                    self.counters["skipped"].add()
+                    continue
+                if object_uuid not in self.existing:
+                    self._put(self.vector_queue, (pid, chunk_text, object_uuid))
+                if object_uuid not in self.existing_key:
+                    future = self.tokenizer_pool.submit(tokenize_chunk, chunk_text)
+                    future.add_done_callback(lambda _: self.counters["tokenized"].add())
+                    self._put(self.keyword_queue, (pid, future, object_uuid))
+        except Exception:
+            self.stopped.set()
+            raise
+        finally:
+            # 中止時 sentinel 可能放不進 queue；consumer 會因 stopped 自行結束
+            for target_queue in (self.vector_queue, self.keyword_queue):
+                try:
+                    self._put(target_queue, _DONE)
+                except PipelineStopped:
+                    pass
+
+    def iter_keywords(self):
+        for pid, future, object_uuid in self._iter_queue(self.keyword_queue, self.counters[self.managerkey.classnm]):
+            yield pid, future.result(), object_uuid
+
+    def consume(self, manager, objects, embedder=None):
+        """插入來自 queue 的物件，回傳有插入失敗的 pid"""
+        pids = []
+
+        def track(items):
+            for item in items:
+                pids.append(item[0])
+                yield item
+
+        try:
+            results = manager.insert_batch(track(objects), embedder=embedder)
+        except Exception:
+            self.stopped.set()
+            raise
+        return {pid for pid, result in zip(pids, results) if result is not True}
+
+    def run(self, directory, txt_files):
+        """執行整個 pipeline，回傳有任何 chunk 插入失敗的 pid"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            vector_future = executor.submit(
+                self.consume, self.manager,
+                self._iter_queue(self.vector_queue, self.counters[self.manager.classnm]), self.embedder,
+            )
+            keyword_future = executor.submit(self.consume, self.managerkey, self.iter_keywords())
+            producer_future = executor.submit(self.produce, directory, txt_files)
+            futures = [vector_future, keyword_future, producer_future]
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            if any(future.exception() is not None for future in done):
+                # 任一 stage 失敗即通知其他 stage 中止，並回報原始錯誤而非其他 stage 的 PipelineStopped
+                self.stopped.set()
+                concurrent.futures.wait(futures)
+                errors = [future.exception() for future in futures if future.exception() is not None]
+                raise next((e for e in errors if not isinstance(e, PipelineStopped)), errors[0])
+        return vector_future.result() | keyword_future.result()
+
+    def stale_ids(self, existing, pids, failed_pids):
+        """已處理文件中不再出現的舊 chunk uuid（插入失敗的文件保留舊資料）"""
+        return [
+            object_uuid for object_uuid, pid in existing.items()
+            if pid in pids and pid not in failed_pids and object_uuid not in self.chunk_ids
+        ]
+
+    def report(self):
+        return "\n".join(counter.report() for counter in self.counters.values())
+
 
 if __name__ == "__main__1":
     """ Delete Classes """
     delete_list = ["Tess", "Ourswoocr", "Ourswomllm", "Oursworewrite", "Ours"]
     for task in delete_list:
         manager = WeaviateManager(task)
-        managerkey = WeaviateManager(f"{task}_key")
+        managerkey = WeaviateManager(f"{task}_key", keyword=True)
         print(manager.delete_class())
         print(managerkey.delete_class())
 
@@ -120,36 +508,80 @@ if __name__ == "__main__1":
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="DB Insert")
     parser.add_argument("--task", choices=["Tess", "Ourswoocr", "Ourswomllm", "Oursworewrite", "Ours"], required=True)
+    parser.add_argument("--incremental", action="store_true", help="Only (re)insert documents whose text changed according to the corpus manifest")
+    parser.add_argument("--client-embed", action="store_true", help="Embed chunks client-side in batches (cached on disk) instead of server-side vectorization")
+    parser.add_argument("--recreate", action="store_true", help="Delete both classes, recreate them with the current schema and re-insert every document")
+    parser.add_argument("--embed-batch-size", type=int, default=256, help="Texts per embeddings API request with --client-embed")
+    parser.add_argument("--tokenize-workers", type=int, default=os.cpu_count(), help="Processes used for jieba tokenization")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="Chunks buffered between pipeline stages")
+    parser.add_argument("--chunk-tokens", type=int, default=8000, help="Target chunk size in embedding-model tokens")
+    parser.add_argument("--chunk-overlap", type=int, default=500, help="Overlap between chunks in tokens")
     args = parser.parse_args()
     manager = WeaviateManager(args.task)
-    managerkey = WeaviateManager(f"{args.task}_key")
+    managerkey = WeaviateManager(f"{args.task}_key", keyword=True)
+    if args.recreate:
+        for target in (manager, managerkey):
+            target.delete_class()
+            target.check_class_exist()
+    elif args.client_embed and manager.legacy_vectors:
+        # 舊 class 的既有向量含 class 名稱、uuid 與 pid，不能與只以 content 計算的向量混用
+        parser.error(f"{manager.classnm} was created with server-side vectorization of every property; "
+                     f"run with --recreate to re-embed it before using --client-embed")
 
     directory = f'result/{args.task}'
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=8000, chunk_overlap=500)
+    text_splitter = TokenChunker(chunk_tokens=args.chunk_tokens, overlap_tokens=args.chunk_overlap)
 
     txt_files = [f for f in os.listdir(directory) if f.endswith('.txt')]
-    all_chunks = []
-
-    for filename in tqdm(txt_files, desc="Preprocessing Files"):
-        file_path = os.path.join(directory, filename)
-        pid = os.path.splitext(filename)[0]
-
-        with open(file_path, encoding='utf-8') as file:
-            content = file.read()
-
-        chunks = text_splitter.split_text(content)
-        all_chunks.extend([(pid, chunk_text) for chunk_text in chunks])
-
-    jieba.set_dictionary('data/dict.txt.big')
-
-    # 統一插入 Weaviate
-    for pid, chunk_text in tqdm(all_chunks, desc="Inserting Data"):
-        manager.insert_data(pid, chunk_text)
-        words = jieba.cut(chunk_text, cut_all=False)
-        cont_keyword = ""
-        for w in words:
-            cont_keyword = cont_keyword + " " + w
-        managerkey.insert_data(pid, cont_keyword)
-        print(f"Keyword: {cont_keyword}")
-        print("========================================")
-        print("========================================")
+
+    all_pids = {os.path.splitext(filename)[0] for filename in txt_files}
+
+    # 以文字檔內容雜湊判斷是否需要重新處理；未變更的文件不再切塊與比對
+    manifest = None
+    stage = f"db:{args.task}"
+    fingerprints = {}
+    if args.incremental:
+        manifest = CorpusManifest()
+        pending_files = []
+        for filename in txt_files:
+            pid = os.path.splitext(filename)[0]
+            fingerprints[pid] = file_sha256(os.path.join(directory, filename))
+            if not args.recreate and manifest.is_current(pid, stage, fingerprints[pid]):
+                continue
+            pending_files.append(filename)
+        print(f"{len(pending_files)} of {len(txt_files)} documents are new or changed")
+        txt_files = pending_files
+
+    tokenizer.get_tokenizer()
+    embedder = BatchEmbedder(openai_api_key, batch_size=args.embed_batch_size) if args.client_embed else None
+
+    # 既有物件的 uuid：未變更的 chunk 略過，不再向量化
+    existing = manager.existing_ids()
+    existing_key = managerkey.existing_ids()
+
+    # 切塊、斷詞與插入以 pipeline 串流進行
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.tokenize_workers, initializer=init_tokenizer) as tokenizer_pool:
+        pipeline = IngestPipeline(manager, managerkey, text_splitter, tokenizer_pool, embedder, args.queue_size, existing, existing_key)
+        failed_pids = pipeline.run(directory, txt_files)
+
+    # 刪除已處理文件中消失的 chunk，以及文字檔已移除的文件
+    pids = {os.path.splitext(filename)[0] for filename in txt_files}
+    for target, target_existing in ((manager, existing), (managerkey, existing_key)):
+        stale = pipeline.stale_ids(target_existing, pids, failed_pids)
+        target.delete_ids(stale)
+        removed_pids = set(target_existing.values()) - all_pids
+        for pid in removed_pids:
+            target.delete_pid(pid)
+        print(f"{target.classnm}: deleted {len(stale)} stale chunks and {len(removed_pids)} removed documents")
+
+    print(pipeline.report())
+    print(text_splitter.report())
+    print(f"{len(failed_pids)} documents had chunks that failed to insert")
+    if embedder is not None:
+        print(embedder.report())
+
+    if manifest is not None:
+        for filename in txt_files:
+            pid = os.path.splitext(filename)[0]
+            if pid not in failed_pids:
+                manifest.mark(pid, stage, fingerprints[pid])
+        manifest.save()
@@ -1,26 +1,26 @@
 import json
 import os
+import time
+import hashlib
+import threading
 import weaviate
+import numpy as np
+from weaviate.config import Config, ConnectionConfig
 import concurrent.futures
 import utils.config_log as config_log
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from datetime import datetime
 from langchain.embeddings import OpenAIEmbeddings
-import jieba
+import utils.tokenizer as tokenizer
+from utils.query_store import QueryStore, QUERY_STORE_DIR
+from utils.alpha_sweep import AlphaSweep
+from utils.query_batcher import QueryBatcher
 import argparse
 
 
-# 設定 alpha
-parser = argparse.ArgumentParser(description="Alpha Setup")
-parser.add_argument("--alpha", required=True)
-args = parser.parse_args()
-
-alpha = float(args.alpha)
-
-
-# 設定 jieba 字典
-jieba.set_dictionary('data/dict.txt.big')
+# 設定 jieba 字典（於啟動多線程前完成初始化）
+tokenizer.get_tokenizer()
 
 # 載入 JSON 檔案的函數
 def load_json(filepath):
@@ -35,31 +35,74 @@ config.read(CONFIG_PATH)
 wea_url = config.get('Weaviate', 'weaviate_url')
 os.environ['OPENAI_API_KEY'] = config.get('OpenAI', 'api_key')
 
+# 所有 task 與 thread 共用同一個 Weaviate client（HTTP 連線池）
+_client = None
+_client_lock = threading.Lock()
+POOL_SIZE = 64
+
+def get_client(pool_size=POOL_SIZE):
+    """共用的 Weaviate client；連線池大小需涵蓋同時進行的查詢數"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            connection_config = ConnectionConfig(session_pool_connections=pool_size, session_pool_maxsize=pool_size)
+            _client = weaviate.Client(url=wea_url, additional_config=Config(connection_config=connection_config))
+        return _client
+
+def map_questions(fn, items, workers=1, desc=None):
+    """
+    以 thread pool 並行執行 fn(item)，依原順序回傳結果（彙總結果與執行順序無關）。
+    同時印出 QPS 與單題延遲的分位數。
+    """
+    def timed(item):
+        start_time = time.perf_counter()
+        result = fn(item)
+        return result, time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        timed_results = list(tqdm(executor.map(timed, items), total=len(items), desc=desc))
+    elapsed = time.perf_counter() - start_time
+
+    latencies = np.array([seconds for _, seconds in timed_results]) * 1000
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(
+            f"{desc}: {len(items)} queries in {elapsed:.1f}s ({len(items) / elapsed:.1f} q/s), "
+            f"latency p50 {p50:.0f} ms / p95 {p95:.0f} ms / p99 {p99:.0f} ms / max {latencies.max():.0f} ms"
+        )
+    return [result for result, _ in timed_results]
+
 # Weaviate 搜尋類別
 class WeaviateHybridSearch:
-    def __init__(self, vector_class, bm25_class):
+    def __init__(self, vector_class, bm25_class, query_store=None, batcher=None):
         self.url = wea_url
         self.embeddings = OpenAIEmbeddings(chunk_size=1, model='text-embedding-3-large')
-        self.client = weaviate.Client(url=wea_url)
+        self.client = get_client()
         self.vector_class = vector_class
         self.bm25_class = bm25_class
-
-    def vector_search(self, query, source):
-        """執行 Vector Search，回傳全部找到的結果"""
-        try:
-            # 產生 query 向量
+        self.query_store = query_store
+        self.batcher = batcher
+
+    def _from_store(self, qid, query):
+        return self.query_store is not None and qid is not None and self.query_store.has(qid, query)
+
+    def _vector_block(self, query, source, qid=None):
+        """Vector Search 的 GraphQL Get block"""
+        # 產生 query 向量（預先計算過的問題直接由 query store 讀取）
+        if self._from_store(qid, query):
+            query_vector = self.query_store.vector(qid)
+        else:
             query_vector = self.embeddings.embed_query(query)
-            vector_str = ','.join(map(str, query_vector))
+        vector_str = ','.join(map(str, query_vector))
 
-            # 建立 GraphQL 條件
-            where_conditions = ' '.join([f'{{path: ["pid"], operator: Equal, valueText: "{pid}"}}' for pid in source])
+        # 建立 GraphQL 條件
+        where_conditions = ' '.join([f'{{path: ["pid"], operator: Equal, valueText: "{pid}"}}' for pid in source])
 
-            # 防止特殊字元影響 GraphQL
-            query_safe = json.dumps(query, ensure_ascii=False)
+        # 防止特殊字元影響 GraphQL
+        query_safe = json.dumps(query, ensure_ascii=False)
 
-            gql_query = f"""
-            {{
-                Get {{
+        return f"""
                     {self.vector_class}(where: {{
                         operator: Or,
                         operands: [{where_conditions}]
@@ -75,35 +118,23 @@ class WeaviateHybridSearch:
                             score
                         }}
                     }}
-                }}
-            }}
-            """
-            search_results = self.client.query.raw(gql_query)
+        """
 
-            if 'errors' in search_results:
-                raise Exception(search_results['errors'][0]['message'])
+    def _bm25_block(self, query, source, qid=None):
+        """BM25 Search 的 GraphQL Get block"""
+        # 使用 jieba 斷詞（預先計算過的問題直接由 query store 讀取）
+        if self._from_store(qid, query):
+            cont_keyword = self.query_store.tokens(qid)
+        else:
+            cont_keyword = tokenizer.tokenize(query)
 
-            return search_results['data']['Get'][self.vector_class]
-        except Exception as e:
-            print(f"Vector search error: {e}")
-            return []
+        # 建立 GraphQL 條件
+        where_conditions = ' '.join([f'{{path: ["pid"], operator: Equal, valueText: "{pid}"}}' for pid in source])
 
-    def bm25_search(self, query, source):
-        """執行 BM25 Search，回傳全部找到的結果"""
-        try:
-            # 使用 jieba 斷詞
-            words = jieba.cut(query, cut_all=False)
-            cont_keyword = " ".join(words)
-
-            # 建立 GraphQL 條件
-            where_conditions = ' '.join([f'{{path: ["pid"], operator: Equal, valueText: "{pid}"}}' for pid in source])
+        # 防止特殊字元影響 GraphQL
+        query_safe = json.dumps(cont_keyword, ensure_ascii=False)
 
-            # 防止特殊字元影響 GraphQL
-            query_safe = json.dumps(cont_keyword, ensure_ascii=False)
-
-            gql_query = f"""
-            {{
-                Get {{
+        return f"""
                     {self.bm25_class}(where: {{
                         operator: Or,
                         operands: [{where_conditions}]
@@ -117,24 +148,62 @@ class WeaviateHybridSearch:
                             score
                         }}
                     }}
-                }}
-            }}
-            """
-            search_results = self.client.query.raw(gql_query)
+        """
+
+    def _submit(self, class_name, build_block, query, source, qid=None):
+        """
+        建立 Get block 並送出，回傳 future。
+        有 batcher 時與其他問題合併為同一個 GraphQL 請求，否則立即單獨查詢。
+        """
+        future = concurrent.futures.Future()
+        try:
+            block = build_block(query, source, qid)
+            if self.batcher is not None:
+                return self.batcher.submit(block)
 
+            search_results = self.client.query.raw(f"{{ Get {{ {block} }} }}")
             if 'errors' in search_results:
                 raise Exception(search_results['errors'][0]['message'])
+            future.set_result(search_results['data']['Get'][class_name])
+        except Exception as e:
+            future.set_exception(e)
+        return future
 
-            return search_results['data']['Get'][self.bm25_class]
+    @staticmethod
+    def _result(future, label):
+        try:
+            return future.result()
         except Exception as e:
-            print(f"BM25 search error: {e}")
+            print(f"{label} search error: {e}")
             return []
 
-    def hybrid_search(self, query, source, alpha):
+    def vector_search(self, query, source, qid=None):
+        """執行 Vector Search，回傳全部找到的結果"""
+        return self._result(self._submit(self.vector_class, self._vector_block, query, source, qid), "Vector")
+
+    def bm25_search(self, query, source, qid=None):
+        """執行 BM25 Search，回傳全部找到的結果"""
+        return self._result(self._submit(self.bm25_class, self._bm25_block, query, source, qid), "BM25")
+
+    def submit_both(self, query, source, qid=None):
+        """同時送出 Vector 與 BM25 查詢（使用 batcher 時兩者位於同一批請求），回傳兩者的 future"""
+        vector_future = self._submit(self.vector_class, self._vector_block, query, source, qid)
+        bm25_future = self._submit(self.bm25_class, self._bm25_block, query, source, qid)
+        return vector_future, bm25_future
+
+    def search_both(self, query, source, qid=None):
+        """回傳 Vector 與 BM25 兩者結果；查詢失敗的一方視為沒有結果"""
+        vector_future, bm25_future = self.submit_both(query, source, qid)
+        return self._result(vector_future, "Vector"), self._result(bm25_future, "BM25")
+
+    def hybrid_search(self, query, source, alpha, qid=None):
         """執行自訂 alpha 的 Hybrid Search，回傳 Top-3 結果"""
-        vector_results = self.vector_search(query, source)
-        bm25_results = self.bm25_search(query, source)
+        vector_results, bm25_results = self.search_both(query, source, qid)
+        return self.fuse(vector_results, bm25_results, alpha)
 
+    @staticmethod
+    def fuse(vector_results, bm25_results, alpha):
+        """以 alpha 加權合併 Vector 與 BM25 結果，回傳 Top-3"""
         # 計算 Aggregative Count
         num = len(vector_results) + len(bm25_results)
         if num == 0:
@@ -175,24 +244,121 @@ ground_truths = {item['qid']: item['retrieve'] for item in load_json(ground_trut
 tasks = ["Tess", "Ourswoocr", "Ourswomllm", "Oursworewrite", "Ours"]
 results_metrics = {}
 
-def evaluate_task(task, alpha):
+RETRIEVAL_CACHE_DIR = "data/cache/retrieval"
+
+def index_fingerprint(task, page_size=1000):
+    """
+    task 的 vector 與 BM25 class 中所有物件 uuid 的雜湊。
+    db_insert 的 uuid 由 chunk 內容決定，重新插入、刪除或修改 chunk 後 fingerprint 隨之改變。
+    """
+    client = get_client()
+    sha = hashlib.sha256()
+    for class_name in (task, f"{task}_key"):
+        ids = []
+        after = None
+        while True:
+            query = client.query.get(class_name, ['pid']).with_additional(['id']).with_limit(page_size)
+            if after is not None:
+                query = query.with_after(after)
+            result = query.do()
+            if 'errors' in result:
+                raise Exception(result['errors'][0]['message'])
+            objects = result['data']['Get'][class_name]
+            if not objects:
+                break
+            ids.extend(obj['_additional']['id'] for obj in objects)
+            after = objects[-1]['_additional']['id']
+        sha.update(f"{class_name}\0{','.join(sorted(ids))}\0".encode('utf-8'))
+    return sha.hexdigest()
+
+def fetch_candidates(task, query_store=None, refresh=False, workers=1, batcher=None):
+    """
+    取得 task 下每個問題的原始 vector / BM25 候選 [(pid, score), ...]，與 alpha 無關。
+    結果快取於 data/cache/retrieval/{task}.json，問題或 source 變更時才重新查詢；
+    索引內容（index_fingerprint）變更時整份快取作廢。查詢失敗的問題不寫入快取，下次執行時重試。
+    """
+    cache_path = os.path.join(RETRIEVAL_CACHE_DIR, f"{task}.json")
+    fingerprint = index_fingerprint(task)
+    cache = {}
+    if os.path.exists(cache_path) and not refresh:
+        cache_file = load_json(cache_path)
+        if cache_file.get('fingerprint') == fingerprint:
+            cache = cache_file['questions']
+
+    searcher = WeaviateHybridSearch(vector_class=task, bm25_class=f"{task}_key", query_store=query_store, batcher=batcher)
+
+    def retrieve(q):
+        vector_future, bm25_future = searcher.submit_both(q['query'], q['source'], q['qid'])
+        try:
+            vector_results, bm25_results = vector_future.result(), bm25_future.result()
+        except Exception as e:
+            print(f"{task} question {q['qid']} search error: {e}")
+            return None
+        return {
+            'query': q['query'],
+            'source': q['source'],
+            'vector': [[res['pid'], res['_additional']['score']] for res in vector_results],
+            'bm25': [[res['pid'], res['_additional']['score']] for res in bm25_results],
+        }
+
+    pending = [
+        q for q in questions
+        if not (cache.get(str(q['qid'])) and cache[str(q['qid'])]['query'] == q['query'] and cache[str(q['qid'])]['source'] == q['source'])
+    ]
+    failed = 0
+    for q, entry in zip(pending, map_questions(retrieve, pending, workers, f"Retrieving {task}")):
+        if entry is None:
+            failed += 1
+            continue
+        cache[str(q['qid'])] = entry
+
+    if len(pending) > failed:
+        os.makedirs(RETRIEVAL_CACHE_DIR, exist_ok=True)
+        with open(f"{cache_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': fingerprint, 'questions': cache}, f, ensure_ascii=False)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    if failed:
+        raise RuntimeError(f"{task}: {failed} of {len(pending)} questions failed to retrieve; rerun to retry them")
+    return cache
+
+def sweep_task(task, alphas, query_store=None, refresh=False, workers=1, batcher=None):
+    """檢索一次，對整個 alpha grid 計算 AP@1 與 MRR；有問題檢索失敗時中止，不以缺少的候選計分"""
+    cache = fetch_candidates(task, query_store, refresh, workers, batcher)
+    sweep = AlphaSweep([
+        (cache[str(q['qid'])]['vector'], cache[str(q['qid'])]['bm25'], ground_truths.get(q['qid']))
+        for q in questions
+    ])
+    return task, sweep.evaluate(alphas)
+
+def evaluate_task(task, alpha, query_store=None, workers=1, batcher=None):
     """
     計算特定 task 的三項指標：
     1. AP@1 (top-1 accuracy)
     2. MRR (第一個正確答案的倒數排名)
+    問題以 workers 個 thread 並行查詢，指標依問題原順序彙總。
+    有問題查詢失敗（例如整批 GraphQL 請求失敗）時中止，不把失敗的問題算成未命中。
     """
     total = 0
     ap1_correct = 0
     mrr_total = 0
-    searcher = WeaviateHybridSearch(vector_class=task, bm25_class=f"{task}_key")
+    searcher = WeaviateHybridSearch(vector_class=task, bm25_class=f"{task}_key", query_store=query_store, batcher=batcher)
+
+    def search(q):
+        vector_future, bm25_future = searcher.submit_both(q['query'], q['source'], q['qid'])
+        try:
+            vector_results, bm25_results = vector_future.result(), bm25_future.result()
+        except Exception as e:
+            print(f"{task} question {q['qid']} search error: {e}")
+            return None
+        return searcher.fuse(vector_results, bm25_results, alpha)
 
-    for q in tqdm(questions, desc=f"Processing {task}"):
-        qid = q['qid']
-        query = q['query']
-        source = q['source']
-        expected = ground_truths.get(qid)
+    all_results = map_questions(search, questions, workers, f"Processing {task}")
+    failed = sum(1 for top_results in all_results if top_results is None)
+    if failed:
+        raise RuntimeError(f"{task}: {failed} of {len(questions)} questions failed to retrieve; metrics not computed")
 
-        top_results = searcher.hybrid_search(query, source, alpha)
+    for q, top_results in zip(questions, all_results):
+        expected = ground_truths.get(q['qid'])
         total += 1
 
         if top_results:
@@ -215,39 +381,62 @@ def evaluate_task(task, alpha):
     metrics = {'AP@1': ap1, 'MRR': mrr}
     return task, metrics
 
-# 多線程執行各個 task 的評估
-with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-    future_to_task = {executor.submit(evaluate_task, task, alpha): task for task in tasks}
-    for future in concurrent.futures.as_completed(future_to_task):
-        task, metrics = future.result()
-        results_metrics[task] = metrics
-
-# 分別整理三個指標的結果
-ap1_results = {task: metrics['AP@1'] for task, metrics in results_metrics.items()}
-mrr_results = {task: metrics['MRR'] for task, metrics in results_metrics.items()}
-
-today = datetime.today().strftime("%m%d")
-
-# 畫出 AP@1 圖表
-plt.figure(figsize=(10, 6))
-plt.bar(ap1_results.keys(), ap1_results.values(), alpha=0.7)
-plt.xlabel('Tasks')
-plt.ylabel('AP@1 (Top-1 Accuracy)')
-plt.title(f'AP@1 Comparison (alpha={alpha})')
-plt.ylim(0, 1)
-for i, v in enumerate(ap1_results.values()):
-    plt.text(i, v + 0.02, f'{v:.2%}', ha='center', fontsize=12)
-plt.savefig(f"result/ap1_comparison_{today}_hybrid_alpha{alpha}.png", dpi=300, bbox_inches='tight')
-plt.show()
-
-# 畫出 MRR 圖表
-plt.figure(figsize=(10, 6))
-plt.bar(mrr_results.keys(), mrr_results.values(), alpha=0.7)
-plt.xlabel('Tasks')
-plt.ylabel('MRR')
-plt.title(f'MRR Comparison (alpha={alpha})')
-plt.ylim(0, 1)
-for i, v in enumerate(mrr_results.values()):
-    plt.text(i, v + 0.02, f'{v:.2%}', ha='center', fontsize=12)
-plt.savefig(f"result/mrr_comparison_{today}_hybrid_alpha{alpha}.png", dpi=300, bbox_inches='tight')
-plt.show()
+if __name__ == "__main__":
+    # 設定 alpha
+    parser = argparse.ArgumentParser(description="Alpha Setup")
+    parser.add_argument("--alpha", required=True)
+    parser.add_argument("--no-query-store", action="store_true", help="Embed and tokenize every question live instead of using the precomputed query store")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent questions per task")
+    parser.add_argument("--batch-size", type=int, default=16, help="Get blocks packed into one GraphQL request (1 disables batching)")
+    parser.add_argument("--flush-ms", type=float, default=10, help="Max wait for a GraphQL batch to fill, in milliseconds")
+    args = parser.parse_args()
+
+    alpha = float(args.alpha)
+    client = get_client(max(POOL_SIZE, args.workers * len(tasks) * 2))
+    batcher = QueryBatcher(client, args.batch_size, args.flush_ms / 1000) if args.batch_size > 1 else None
+
+    # 問題的向量與斷詞結果只計算一次，各 task 與 alpha 共用
+    query_store = None
+    if not args.no_query_store:
+        query_store = QueryStore.load_or_build(questions, QUERY_STORE_DIR, os.environ['OPENAI_API_KEY'])
+
+    # 多線程執行各個 task 的評估
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        future_to_task = {executor.submit(evaluate_task, task, alpha, query_store, args.workers, batcher): task for task in tasks}
+        for future in concurrent.futures.as_completed(future_to_task):
+            task, metrics = future.result()
+            results_metrics[task] = metrics
+
+    if batcher is not None:
+        batcher.close()
+        print(batcher.report())
+
+    # 分別整理三個指標的結果
+    ap1_results = {task: metrics['AP@1'] for task, metrics in results_metrics.items()}
+    mrr_results = {task: metrics['MRR'] for task, metrics in results_metrics.items()}
+
+    today = datetime.today().strftime("%m%d")
+
+    # 畫出 AP@1 圖表
+    plt.figure(figsize=(10, 6))
+    plt.bar(ap1_results.keys(), ap1_results.values(), alpha=0.7)
+    plt.xlabel('Tasks')
+    plt.ylabel('AP@1 (Top-1 Accuracy)')
+    plt.title(f'AP@1 Comparison (alpha={alpha})')
+    plt.ylim(0, 1)
+    for i, v in enumerate(ap1_results.values()):
+        plt.text(i, v + 0.02, f'{v:.2%}', ha='center', fontsize=12)
+    plt.savefig(f"result/ap1_comparison_{today}_hybrid_alpha{alpha}.png", dpi=300, bbox_inches='tight')
+    plt.show()
+
+    # 畫出 MRR 圖表
+    plt.figure(figsize=(10, 6))
+    plt.bar(mrr_results.keys(), mrr_results.values(), alpha=0.7)
+    plt.xlabel('Tasks')
+    plt.ylabel('MRR')
+    plt.title(f'MRR Comparison (alpha={alpha})')
+    plt.ylim(0, 1)
+    for i, v in enumerate(mrr_results.values()):
+        plt.text(i, v + 0.02, f'{v:.2%}', ha='center', fontsize=12)
+    plt.savefig(f"result/mrr_comparison_{today}_hybrid_alpha{alpha}.png", dpi=300, bbox_inches='tight')
+    plt.show()
@@ -4,8 +4,8 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 import utils.ai.claude_tem as call_ai
 
-def ours(ocr_text):
-  PROMPT = f"""請擔任專業的繁體中文知識改寫專家，基於 OCR 轉換後的文本進行改寫，使其滿足混合檢索（BM25 + Dense Retrieval）的需求。
+# 固定指令作為快取前綴，每份文件的 OCR 文本接在其後
+INSTRUCTIONS = """請擔任專業的繁體中文知識改寫專家，基於 OCR 轉換後的文本進行改寫，使其滿足混合檢索（BM25 + Dense Retrieval）的需求。
 
 你的任務包括以下幾點：
 
@@ -37,18 +37,21 @@ def ours(ocr_text):
 
 ---
 
-請基於以下 OCR 後的雜亂文本進行優化改寫：  
-{ocr_text}
-
----
-
 輸出格式：
 1. 請輸出「完整」文本，確保文本上的所有內容皆有輸出
 2. 請不要輸出任何與文本無關的其他字元
 3. 請用繁體中文"""
 
 
-  response = call_ai.template(PROMPT, None)
+def build_prompt(ocr_text):
+  PROMPT = f"""請基於以下 OCR 後的雜亂文本進行優化改寫：  
+{ocr_text}"""
+
+  return PROMPT
+
+
+def ours(ocr_text):
+  response = call_ai.template(build_prompt(ocr_text), None, prefix=INSTRUCTIONS)
   return response
 
 
@@ -4,8 +4,8 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 import utils.ai.claude_tem as call_ai
 
-def ours(image_bytes):
-  PROMPT = f"""請擔任專業的繁體中文知識改寫專家，基於圖片轉換後的文本進行改寫，使其滿足混合檢索（BM25 + Dense Retrieval）的需求。
+# 本設定沒有 OCR 文本，整段指令皆為固定前綴，只有頁面圖片會變動
+INSTRUCTIONS = """請擔任專業的繁體中文知識改寫專家，基於圖片轉換後的文本進行改寫，使其滿足混合檢索（BM25 + Dense Retrieval）的需求。
 
 你的任務包括以下幾點：
 
@@ -42,7 +42,12 @@ def ours(image_bytes):
 3. 請用繁體中文"""
 
 
-  response = call_ai.template(PROMPT, image_bytes)
+def build_prompt():
+  return ""
+
+
+def ours(image_bytes, image_media_type="image/png"):
+  response = call_ai.template(build_prompt(), image_bytes, image_media_type, prefix=INSTRUCTIONS)
   return response
 
 
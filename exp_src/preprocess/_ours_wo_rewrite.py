@@ -5,8 +5,8 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")
 import utils.ai.claude_tem as call_ai
 
 
-def ours(image_bytes, ocr_text):
-  PROMPT = f"""請擔任專業的繁體中文知識改寫專家，基於 OCR 轉換後的文本進行修正。
+# 固定的修正指令作為快取前綴，頁面圖片與 OCR 文本接在其後
+INSTRUCTIONS = """請擔任專業的繁體中文知識改寫專家，基於 OCR 轉換後的文本進行修正。
 
 你的任務為以下這點：
 
@@ -15,11 +15,6 @@ def ours(image_bytes, ocr_text):
 
 ---
 
-請基於以下 OCR 後的雜亂文本進行優化改寫：  
-{ocr_text}
-
----
-
 你可以參考附件的圖片協助你理解這段文本在原 PDF 檔案上是以什麼格式 (e.g. 表格、敘述句) 呈現，各個文字、數字又分別代表什麼、呈現在原文哪些位置。
 
 輸出格式：
@@ -27,7 +22,16 @@ def ours(image_bytes, ocr_text):
 2. 請不要輸出任何與文本無關的其他字元
 3. 請用繁體中文"""
 
-  response = call_ai.template(PROMPT, image_bytes)
+
+def build_prompt(ocr_text):
+  PROMPT = f"""請基於以下 OCR 後的雜亂文本進行優化改寫：  
+{ocr_text}"""
+
+  return PROMPT
+
+
+def ours(image_bytes, ocr_text, image_media_type="image/png"):
+  response = call_ai.template(build_prompt(ocr_text), image_bytes, image_media_type, prefix=INSTRUCTIONS)
   return response
 
 
@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import hashlib
+import threading
+
+OCR_CACHE_PATH = "data/cache/ocr_cache.sqlite"
+
+class OCRCache:
+    """
+    Content-addressed OCR result cache stored in SQLite.
+
+    Entries are keyed by the SHA-256 of the page image bytes plus the tesseract language
+    and version, so every preprocessing variant and every re-run shares the same results.
+    Each process opens its own connection; WAL mode lets OCR workers write concurrently.
+    Threads of one process share the connection under a lock.
+    """
+
+    def __init__(self, path=OCR_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr ("
+            "image_hash TEXT, lang TEXT, version TEXT, text TEXT, "
+            "PRIMARY KEY (image_hash, lang, version))"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def image_hash(image_bytes):
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def get(self, image_bytes, lang, version):
+        image_hash = self.image_hash(image_bytes)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT text FROM ocr WHERE image_hash = ? AND lang = ? AND version = ?",
+                (image_hash, lang, version),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, image_bytes, lang, version, text):
+        image_hash = self.image_hash(image_bytes)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO ocr (image_hash, lang, version, text) VALUES (?, ?, ?, ?)",
+                (image_hash, lang, version, text),
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,18 +1,97 @@
+import sys
+import os
+import threading
+import concurrent.futures
+from collections import deque
 import pytesseract
 from PIL import Image
 from io import BytesIO
 
-def tessocr(image_bytes):
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+import preprocess.ocr._cache as ocr_cache
+
+# 每個 process 各自開啟快取連線與查詢 tesseract 版本；同一 process 的 thread 共用，初始化時加鎖
+_cache = None
+_tesseract_version = None
+_init_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _init_lock:
+        if _cache is None:
+            _cache = ocr_cache.OCRCache()
+        return _cache
+
+def get_tesseract_version():
+    global _tesseract_version
+    with _init_lock:
+        if _tesseract_version is None:
+            _tesseract_version = str(pytesseract.get_tesseract_version())
+        return _tesseract_version
+
+def tessocr(image_bytes, lang="chi_tra", use_cache=True):
     if image_bytes is None:
         return "Error: No image data provided."
 
     try:
+        if use_cache:
+            cached = get_cache().get(image_bytes, lang, get_tesseract_version())
+            if cached is not None:
+                return cached
+
         image = Image.open(BytesIO(image_bytes))
-        text = pytesseract.image_to_string(image, lang="chi_tra")
-        return text.strip()
+        text = pytesseract.image_to_string(image, lang=lang).strip()
+
+        if use_cache:
+            get_cache().put(image_bytes, lang, get_tesseract_version(), text)
+        return text
     except Exception as e:
         return f"Error: {str(e)}"
 
+def _init_worker(threads_per_worker):
+    # tesseract 透過 OpenMP 多執行緒；限制每個 worker 的執行緒數，避免 CPU 過度分配
+    os.environ["OMP_THREAD_LIMIT"] = str(threads_per_worker)
+
+class TessOCREngine:
+    """Persistent process pool running tessocr, returning results in input order."""
+
+    def __init__(self, workers=None, threads_per_worker=1, lang="chi_tra", max_pending=None, use_cache=True):
+        self.workers = workers or os.cpu_count() or 1
+        self.lang = lang
+        self.use_cache = use_cache
+        self.max_pending = max_pending or self.workers * 2
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(threads_per_worker,)
+        )
+
+    def imap(self, images):
+        """
+        OCR an iterable of image bytes, yielding texts in the same order.
+
+        At most `max_pending` images are submitted ahead of the consumer, so every worker
+        stays busy while memory stays bounded for long (or lazily read) inputs.
+        """
+        pending = deque()
+        for image_bytes in images:
+            pending.append(self.executor.submit(tessocr, image_bytes, self.lang, self.use_cache))
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def tessocr_batch(self, images):
+        """OCR a batch of image bytes; returns the list of texts in page order."""
+        return list(self.imap(images))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 if __name__ == "__main__":
     import time
     start_time = time.time()
@@ -1,19 +1,40 @@
 import os
+import json
+import time
+import hashlib
 import argparse
+import functools
+import threading
+import concurrent.futures
+from collections import deque
 from tqdm import tqdm
+from pdf2image import pdfinfo_from_path
 
+import convert_pdfs_to_images as rasterizer
 import preprocess.ocr._tesseract as tessocrapp
 import preprocess._ours_wo_ocr as ourswoocrapp
 import preprocess._ours_wo_mllm as ourswomllmapp
 import preprocess._ours_wo_rewrite as oursworewriteapp
 import preprocess._ours as oursapp
+import utils.ai.claude_tem as call_ai
+import utils.ai.claude_batch as claude_batch
+from utils.image_prep import ImagePreparer
+from utils.journal import PageJournal
+from utils.manifest import CorpusManifest, file_sha256
+from utils.page_scheduler import PageTracker, submit_pages
 
+TASKS = ["Tess", "Ourswoocr", "Ourswomllm", "Oursworewrite", "Ours"]
+
+PDF_DIR = "data/esun_dataset/reference/finance_source"
 IMG_DIR = "data/esun_dataset/reference/finance_source_img"
 OCR_TEXT_DIR = "result/Tess"
+PAGES_SUBDIR = "pages"
+BATCH_STATE_FILE = ".batches.json"
+JOURNAL_FILE = ".journal.jsonl"
 
-def count_total_images(img_dir):
+def count_total_images(img_dir, pdf_folders=None):
     total_images = 0
-    for pdf_folder in os.listdir(img_dir):
+    for pdf_folder in (os.listdir(img_dir) if pdf_folders is None else pdf_folders):
         pdf_folder_path = os.path.join(img_dir, pdf_folder)
         if os.path.isdir(pdf_folder_path):
             total_images += len([f for f in os.listdir(pdf_folder_path) if f.endswith(".png")])
@@ -29,65 +50,800 @@ def load_ocr_texts(ocr_text_dir):
                 ocr_texts[pdf_folder] = file.read()
     return ocr_texts
 
-def process_images(img_dir, ocr_text_dir, output_dir, task):
+def load_ocr_pages(ocr_text_dir):
+    """Load page-aligned OCR text as {pdf_folder: {page_number: text}} from the pages/ index."""
+    ocr_pages = {}
+    pages_dir = os.path.join(ocr_text_dir, PAGES_SUBDIR)
+    if not os.path.isdir(pages_dir):
+        return ocr_pages
+    for json_file in os.listdir(pages_dir):
+        if json_file.endswith(".json"):
+            pdf_folder = os.path.splitext(json_file)[0]
+            with open(os.path.join(pages_dir, json_file), "r", encoding="utf-8") as file:
+                ocr_pages[pdf_folder] = {int(page): text for page, text in json.load(file).items()}
+    return ocr_pages
+
+def save_result(output_dir, pdf_folder, page_texts):
+    """
+    Write `{pdf_folder}.txt` and, for page-level outputs, a `pages/{pdf_folder}.json` index.
+
+    `page_texts` is a list of (page_number, text); a page number of None marks a
+    document-level output that has no page index.
+    """
+    with open(os.path.join(output_dir, f"{pdf_folder}.txt"), "w", encoding="utf-8") as txt_file:
+        txt_file.write("\n\n".join(text for _, text in page_texts))
+
+    if any(page is None for page, _ in page_texts):
+        return
+    pages_dir = os.path.join(output_dir, PAGES_SUBDIR)
+    os.makedirs(pages_dir, exist_ok=True)
+    with open(os.path.join(pages_dir, f"{pdf_folder}.json"), "w", encoding="utf-8") as json_file:
+        json.dump({str(page): text for page, text in page_texts}, json_file, ensure_ascii=False)
+
+def rewrite_document(ocr_text):
+    """Ourswomllm is text-only, so it runs once per document rather than once per page."""
+    return [(None, ourswomllmapp.ours(ocr_text))]
+
+def run_document(pdf_folder, ocr_text, journal=None):
+    """`rewrite_document` that reuses, or records, the document's result in the journal."""
+    if journal is None:
+        return rewrite_document(ocr_text)
+
+    document_hash = task_input_hash("Ourswomllm", None, ocr_text)
+    done = journal.completed(pdf_folder, {None: document_hash})
+    if None in done:
+        return [(None, done[None])]
+
+    start_time = time.time()
+    try:
+        page_texts = rewrite_document(ocr_text)
+    except Exception as e:
+        journal.record(pdf_folder, None, None, time.time() - start_time, error=str(e), input_hash=document_hash)
+        raise
+    journal.record(pdf_folder, None, page_texts[0][1], time.time() - start_time, input_hash=document_hash)
+    return page_texts
+
+def run_task(task, image_bytes, ocr_text, image_media_type="image/png"):
+    """Run one preprocessing variant on a single page, given that page's OCR text."""
+    if task == "Tess":
+        return tessocrapp.tessocr(image_bytes)
+    elif task == "Ourswoocr":
+        return ourswoocrapp.ours(image_bytes, image_media_type)
+    elif task == "Ourswomllm":
+        return ourswomllmapp.ours(ocr_text)
+    elif task == "Oursworewrite":
+        return oursworewriteapp.ours(image_bytes, ocr_text, image_media_type)
+    elif task == "Ours":
+        return oursapp.ours(image_bytes, ocr_text, image_media_type)
+    else:
+        raise ValueError("Invalid task.")
+
+def task_version(task):
+    """Model and prompt template behind `task`'s output; part of every journal input hash."""
+    if task == "Tess":
+        return "tesseract"
+    instructions, prompt = build_prompt(task, "")
+    return f"{call_ai.MODEL}\n{instructions}\n{prompt}"
+
+def task_input_hash(task, image_digest, ocr_text, image_preparer=None):
+    """Journal input hash of one page (one document for Ourswomllm); None while its OCR text is unknown."""
+    # Tess 與 Ourswoocr 不使用 OCR 文本，Ourswomllm 不使用頁面圖片
+    if task in ("Tess", "Ourswoocr"):
+        ocr_text = ""
+    elif ocr_text is None:
+        return None
+    if task == "Ourswomllm":
+        image_digest = ""
+    parts = [image_digest, ocr_text, task_version(task)]
+    # 送給 Claude 的是縮放／轉檔後的圖片，前處理設定也是輸入的一部分
+    if task not in ("Tess", "Ourswomllm") and image_preparer is not None:
+        parts.append(image_preparer.settings())
+    return PageJournal.input_hash(*parts)
+
+def page_input_hash(task, page, image_bytes, ocr_pages, ocr_text="", image_preparer=None):
+    """Journal input hash of one page, from the image bytes as read and that page's OCR text."""
+    return task_input_hash(task, hashlib.sha256(image_bytes).hexdigest(), ocr_pages.get(page, ocr_text), image_preparer)
+
+def reuse_completed(pages, journal, pdf_folder, page_hash, done, input_hashes):
+    """
+    Pass on the (page_number, image_bytes) of `pages` that `journal` does not hold for the same inputs.
+
+    Each page's input hash is `page_hash(page, image_bytes)` over the bytes just read, so
+    images are read once; hashes go into `input_hashes` and reused outputs into `done`.
+    """
+    for page, image_bytes in pages:
+        if journal is None:
+            yield page, image_bytes
+            continue
+        input_hashes[page] = page_hash(page, image_bytes)
+        reused = journal.completed(pdf_folder, {page: input_hashes[page]})
+        if page in reused:
+            done[page] = reused[page]
+            continue
+        yield page, image_bytes
+
+def iter_image_pages(pdf_folder_path):
+    """Yield (page_number, image_bytes) for the page PNGs of one PDF folder, in page order."""
+    # 先篩出 {page}.png 再排序，略過中斷時留下的暫存檔與資料夾
+    image_files = sorted(
+        (f for f in os.listdir(pdf_folder_path) if f.endswith(".png") and os.path.splitext(f)[0].isdigit()),
+        key=lambda x: int(os.path.splitext(x)[0]),
+    )
+    for image_file in image_files:
+        img_path = os.path.join(pdf_folder_path, image_file)
+        with open(img_path, "rb") as img_file:
+            yield int(os.path.splitext(image_file)[0]), img_file.read()
+
+def process_images(img_dir, ocr_text_dir, output_dir, task, ocr_engine=None, image_preparer=None, journal=None, pdf_folders=None):
     os.makedirs(output_dir, exist_ok=True)
 
-    total_images = count_total_images(img_dir)
+    total_images = count_total_images(img_dir, pdf_folders)
     progress_bar = tqdm(total=total_images, desc="Processing Images", unit="page")
 
     ocr_texts = load_ocr_texts(ocr_text_dir)
+    ocr_pages = load_ocr_pages(ocr_text_dir)
 
-    for pdf_folder in os.listdir(img_dir):
+    for pdf_folder in (os.listdir(img_dir) if pdf_folders is None else pdf_folders):
         try:
             pdf_folder_path = os.path.join(img_dir, pdf_folder)
             if not os.path.isdir(pdf_folder_path):
                 continue
 
-            txt_file_path = os.path.join(output_dir, f"{pdf_folder}.txt")
-            all_text = []
+            ocr_text = ocr_texts.get(pdf_folder, "")
+
+            if task == "Ourswomllm":
+                page_texts = run_document(pdf_folder, ocr_text, journal)
+                progress_bar.update(len([f for f in os.listdir(pdf_folder_path) if f.endswith(".png")]))
+            else:
+                page_ocr = ocr_pages.get(pdf_folder, {})
+                done, input_hashes = {}, {}
+                pages = reuse_completed(
+                    iter_image_pages(pdf_folder_path), journal, pdf_folder,
+                    lambda page, image_bytes: page_input_hash(task, page, image_bytes, page_ocr, ocr_text, image_preparer),
+                    done, input_hashes,
+                )
+                page_texts = []
+                for page, response_text in rewrite_pages(pages, task, page_ocr, ocr_text, ocr_engine, image_preparer, journal, pdf_folder, input_hashes):
+                    page_texts.append((page, response_text))
+                    progress_bar.update(1)
+                page_texts.extend(done.items())
+                progress_bar.update(len(done))
+                page_texts.sort(key=lambda x: x[0])
+
+            write_result(output_dir, pdf_folder, page_texts, journal)
+
+        except Exception as e:
+            print(f'for "{str(pdf_folder)}" Unexpected error: {str(e)}')
+
+    progress_bar.close()
+
+def write_result(output_dir, pdf_folder, page_texts, journal=None):
+    """`save_result` unless a page of `pdf_folder` failed; such a PDF is left for a rerun."""
+    if report_failures(journal, pdf_folder):
+        return False
+    if any(PageJournal.is_error(text) for _, text in page_texts):
+        print(f'for "{str(pdf_folder)}" not written: a page failed')
+        return False
+    save_result(output_dir, pdf_folder, page_texts)
+    return True
+
+def report_failures(journal, pdf_folder):
+    """True when the journal holds failed pages for `pdf_folder`, which is then not written."""
+    if journal is None:
+        return False
+    failed_pages = journal.failed(pdf_folder)
+    if failed_pages:
+        print(f'for "{str(pdf_folder)}" {len(failed_pages)} page(s) failed; rerun to retry them')
+    return bool(failed_pages)
+
+def prepare_image(image_bytes, image_preparer=None):
+    """Shrink a page image for an MLLM call; returns (image_bytes, media_type)."""
+    if image_preparer is None:
+        return image_bytes, "image/png"
+    return image_preparer.prepare(image_bytes)
+
+def process_page(task, image_bytes, ocr_text, image_preparer=None):
+    """Run one variant on one page; images sent to Claude are prepared first, Tess OCRs the original."""
+    image_media_type = "image/png"
+    if task != "Tess":
+        image_bytes, image_media_type = prepare_image(image_bytes, image_preparer)
+    return run_task(task, image_bytes, ocr_text, image_media_type)
+
+def rewrite_pages(pages, task, ocr_pages, ocr_text="", ocr_engine=None, image_preparer=None, journal=None, pdf_folder=None, input_hashes=None):
+    """
+    Generator stage: turn (page_number, image_bytes) into (page_number, text).
+
+    Each page receives only its own OCR text from `ocr_pages`; OCR output written before
+    the page index existed falls back to the whole-document `ocr_text`. For the Tess task
+    an optional TessOCREngine OCRs pages on its process pool; results are still yielded
+    in page order. With a `journal`, each page's output, status, timing and input hash
+    (from `input_hashes`) is recorded, and a page that raises is recorded as failed and
+    skipped instead of aborting the PDF.
+    """
+    if input_hashes is None:
+        input_hashes = {}
+    if task == "Tess" and ocr_engine is not None:
+        page_numbers = deque()
+
+        def images():
+            for page, image_bytes in pages:
+                page_numbers.append(page)
+                yield image_bytes
+
+        start_time = time.time()
+        for text in ocr_engine.imap(images()):
+            page = page_numbers.popleft()
+            if journal is not None:
+                journal.record(pdf_folder, page, text, time.time() - start_time, input_hash=input_hashes.get(page))
+            yield page, text
+            start_time = time.time()
+        return
+
+    for page, image_bytes in pages:
+        start_time = time.time()
+        try:
+            response_text = process_page(task, image_bytes, ocr_pages.get(page, ocr_text), image_preparer)
+        except Exception as e:
+            if journal is None:
+                raise
+            print(f'for "{str(pdf_folder)}" page {page} Unexpected error: {str(e)}')
+            journal.record(pdf_folder, page, None, time.time() - start_time, error=str(e), input_hash=input_hashes.get(page))
+            continue
+        if journal is not None:
+            journal.record(pdf_folder, page, response_text, time.time() - start_time, input_hash=input_hashes.get(page))
+        yield page, response_text
+
+def process_images_concurrent(img_dir, ocr_text_dir, output_dir, task, workers, max_inflight=None, image_preparer=None, journal=None, pdf_folders=None):
+    """
+    Schedule page jobs from every PDF onto a bounded thread pool.
+
+    At most `max_inflight` page images are held in memory at once. Each PDF's text is
+    written in page order as soon as its last page finishes; a PDF with a failed page is
+    not written, matching `process_images`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    max_inflight = max_inflight or workers * 2
+
+    total_images = count_total_images(img_dir, pdf_folders)
+    progress_bar = tqdm(total=total_images, desc="Processing Images", unit="page")
+
+    ocr_texts = load_ocr_texts(ocr_text_dir)
+    ocr_pages = load_ocr_pages(ocr_text_dir)
+
+    inflight = threading.BoundedSemaphore(max_inflight)
+
+    def write_pdf(pdf_folder, results, failed):
+        if failed:
+            return
+        try:
+            write_result(output_dir, pdf_folder, sorted(results.items(), key=lambda x: x[0] or 0), journal)
+        except Exception as e:
+            print(f'for "{str(pdf_folder)}" Unexpected error: {str(e)}')
+
+    tracker = PageTracker(write_pdf)
+
+    def run_page(pdf_folder, page, image_bytes, ocr_text, weight, input_hash=None):
+        start_time = time.time()
+        try:
+            if task == "Ourswomllm":
+                response_text = run_document(pdf_folder, ocr_text, journal)[0][1]
+            else:
+                response_text = process_page(task, image_bytes, ocr_text, image_preparer)
+                if journal is not None:
+                    journal.record(pdf_folder, page, response_text, time.time() - start_time, input_hash=input_hash)
+        except Exception as e:
+            print(f'for "{str(pdf_folder)}" page {page} Unexpected error: {str(e)}')
+            if journal is not None and task != "Ourswomllm":
+                journal.record(pdf_folder, page, None, time.time() - start_time, error=str(e), input_hash=input_hash)
+            response_text = None
+        finally:
+            inflight.release()
+
+        tracker.add(pdf_folder, page, response_text, failed=response_text is None)
+        progress_bar.update(weight)
+
+    def schedule(pdf_folder, ocr_text, input_hashes, page, image_bytes):
+        tracker.job(pdf_folder)
+        page_ocr_text = ocr_pages.get(pdf_folder, {}).get(page, ocr_text)
+        executor.submit(run_page, pdf_folder, page, image_bytes, page_ocr_text, 1, input_hashes.get(page))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for pdf_folder in (os.listdir(img_dir) if pdf_folders is None else pdf_folders):
+            pdf_folder_path = os.path.join(img_dir, pdf_folder)
+            if not os.path.isdir(pdf_folder_path):
+                continue
 
             ocr_text = ocr_texts.get(pdf_folder, "")
+            page_ocr = ocr_pages.get(pdf_folder, {})
+            done, input_hashes = {}, {}
+            tracker.start(pdf_folder)
+
+            failed = False
+            try:
+                if task == "Ourswomllm":
+                    inflight.acquire()
+                    weight = len([f for f in os.listdir(pdf_folder_path) if f.endswith(".png")])
+                    tracker.job(pdf_folder)
+                    executor.submit(run_page, pdf_folder, None, None, ocr_text, weight)
+                else:
+                    pages = reuse_completed(
+                        iter_image_pages(pdf_folder_path), journal, pdf_folder,
+                        lambda page, image_bytes: page_input_hash(task, page, image_bytes, page_ocr, ocr_text, image_preparer),
+                        done, input_hashes,
+                    )
+                    submit_pages(pages, inflight, functools.partial(schedule, pdf_folder, ocr_text, input_hashes))
+            except Exception as e:
+                print(f'for "{str(pdf_folder)}" Unexpected error: {str(e)}')
+                failed = True
+            progress_bar.update(len(done))
+            tracker.close(pdf_folder, done, failed)
+
+    progress_bar.close()
+
+def process_images_multi(img_dir, ocr_text_dir, output_dirs, workers, max_inflight=None, image_preparer=None, journals=None, pdf_folders=None):
+    """
+    Single pass over the corpus for several tasks at once (`output_dirs`: task -> dir).
+
+    Each page is read and decoded once, OCRed at most once (when Tess is requested, its
+    output feeds the other variants in the same pass) and prepared once; it is then
+    dispatched concurrently to every requested Claude variant. Ourswomllm runs once per
+    PDF after all its pages are OCRed. All task outputs of a PDF are written together.
+    """
+    journals = journals or {}
+    tasks = list(output_dirs)
+    page_tasks = [task for task in tasks if task != "Ourswomllm"]
+    claude_page_tasks = [task for task in page_tasks if task != "Tess"]
+    run_ocr = "Tess" in tasks
+    for output_dir in output_dirs.values():
+        os.makedirs(output_dir, exist_ok=True)
+
+    total_images = count_total_images(img_dir, pdf_folders)
+    progress_bar = tqdm(total=total_images, desc="Processing Images", unit="page")
+
+    ocr_texts = load_ocr_texts(ocr_text_dir) if os.path.isdir(ocr_text_dir) else {}
+    ocr_pages = load_ocr_pages(ocr_text_dir)
+
+    inflight = threading.BoundedSemaphore(max_inflight or workers * 2)
 
-            image_files = sorted(os.listdir(pdf_folder_path), key=lambda x: int(os.path.splitext(x)[0]))
-            for image_file in image_files:
-                if not image_file.endswith(".png"):
-                    continue
+    def journaled(task, pdf_folder, page, func, input_hash=None):
+        journal = journals.get(task)
+        start_time = time.time()
+        try:
+            text = func()
+        except Exception as e:
+            print(f'for "{str(pdf_folder)}" page {page} ({task}) Unexpected error: {str(e)}')
+            if journal is not None:
+                journal.record(pdf_folder, page, None, time.time() - start_time, error=str(e), input_hash=input_hash)
+            return None
+        if journal is not None:
+            journal.record(pdf_folder, page, text, time.time() - start_time, input_hash=input_hash)
+        return text
 
-                img_path = os.path.join(pdf_folder_path, image_file)
-                with open(img_path, "rb") as img_file:
-                    image_bytes = img_file.read()
+    def write_document(pdf_folder, ocr_text):
+        try:
+            page_texts = run_document(pdf_folder, ocr_text, journals.get("Ourswomllm"))
+            write_result(output_dirs["Ourswomllm"], pdf_folder, page_texts, journals.get("Ourswomllm"))
+        except Exception as e:
+            print(f'for "{str(pdf_folder)}" (Ourswomllm) Unexpected error: {str(e)}')
 
-                    if task == "Tess":
-                        response_text = tessocrapp.tessocr(image_bytes)
-                    elif task == "Ourswoocr":
-                        response_text = ourswoocrapp.ours(image_bytes)
-                    elif task == "Ourswomllm":
-                        response_text = ourswomllmapp.ours(ocr_text)
-                    elif task == "Oursworewrite":
-                        response_text = oursworewriteapp.ours(image_bytes, ocr_text)
-                    elif task == "Ours":
-                        response_text = oursapp.ours(image_bytes, ocr_text)
-                    else:
-                        raise ValueError("Invalid task.")
+    def write_pdf(pdf_folder, results, failed):
+        # results: {page: {task: text}}
+        if failed:
+            return
+        for task in page_tasks:
+            page_texts = sorted((page, outputs.get(task)) for page, outputs in results.items())
+            try:
+                write_result(output_dirs[task], pdf_folder, page_texts, journals.get(task))
+            except Exception as e:
+                print(f'for "{str(pdf_folder)}" ({task}) Unexpected error: {str(e)}')
 
-                    all_text.append(response_text)
+        if "Ourswomllm" in tasks:
+            if run_ocr:
+                # 只有整份 PDF 的 OCR 都成功時才改寫，避免以缺頁的文字產生結果
+                ocr_pages_done = sorted((page, outputs.get("Tess")) for page, outputs in results.items())
+                if any(PageJournal.is_error(text) for _, text in ocr_pages_done) or ("Tess" in journals and journals["Tess"].failed(pdf_folder)):
+                    print(f'for "{str(pdf_folder)}" (Ourswomllm) skipped: OCR did not succeed on every page')
+                    return
+                ocr_text = "\n\n".join(text for _, text in ocr_pages_done)
+            else:
+                ocr_text = ocr_texts.get(pdf_folder, "")
+            variant_executor.submit(write_document, pdf_folder, ocr_text)
 
-                progress_bar.update(1)
+    tracker = PageTracker(write_pdf)
 
-            with open(txt_file_path, "w", encoding="utf-8") as txt_file:
-                txt_file.write("\n\n".join(all_text))
+    def reused(task, pdf_folder, page, input_hash):
+        """(True, output) when the journal of `task` holds `page` for the same inputs"""
+        journal = journals.get(task)
+        done = journal.completed(pdf_folder, {page: input_hash}) if journal is not None else {}
+        return page in done, done.get(page)
+
+    def run_page(pdf_folder, page, image_bytes):
+        outputs = {}
+        try:
+            # 以讀入的圖片內容計算雜湊，再與 OCR 文本、prompt、模型與前處理設定比對 journal，
+            # 輸入變更的頁面重新處理
+            image_digest = hashlib.sha256(image_bytes).hexdigest()
+            if run_ocr:
+                ocr_hash = task_input_hash("Tess", image_digest, None)
+                found, ocr_text = reused("Tess", pdf_folder, page, ocr_hash)
+                if not found:
+                    ocr_text = journaled("Tess", pdf_folder, page, lambda: tessocrapp.tessocr(image_bytes), ocr_hash)
+                outputs["Tess"] = ocr_text
+            else:
+                ocr_text = ocr_pages.get(pdf_folder, {}).get(page, ocr_texts.get(pdf_folder, ""))
+
+            pending = {}
+            for task in claude_page_tasks:
+                input_hash = task_input_hash(task, image_digest, ocr_text or "", image_preparer)
+                found, outputs[task] = reused(task, pdf_folder, page, input_hash)
+                if not found:
+                    pending[task] = input_hash
+            if pending and run_ocr and PageJournal.is_error(ocr_text):
+                # tessocr 失敗時回傳 "Error: ..." 而不是拋出例外；不把錯誤字串送給 Claude，
+                # 這一頁的 Claude variant 直接記為失敗，下次重跑時連同 OCR 一起重做
+                for task in pending:
+                    outputs[task] = None
+                    if task in journals:
+                        journals[task].record(pdf_folder, page, None, 0, error=f"OCR failed: {ocr_text}")
+            elif pending:
+                prepared_bytes, image_media_type = prepare_image(image_bytes, image_preparer)
+                futures = {
+                    task: variant_executor.submit(
+                        journaled, task, pdf_folder, page,
+                        lambda task=task: run_task(task, prepared_bytes, ocr_text or "", image_media_type),
+                        input_hash,
+                    )
+                    for task, input_hash in pending.items()
+                }
+                for task, future in futures.items():
+                    outputs[task] = future.result()
+        except Exception as e:
+            print(f'for "{str(pdf_folder)}" page {page} Unexpected error: {str(e)}')
+        finally:
+            inflight.release()
+
+        tracker.add(pdf_folder, page, outputs)
+        progress_bar.update(1)
+
+    def schedule(pdf_folder, page, image_bytes):
+        tracker.job(pdf_folder)
+        page_executor.submit(run_page, pdf_folder, page, image_bytes)
+
+    # page_executor 先結束（等待所有頁面），再由 variant_executor 等待文件層級的 Ourswomllm
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers * max(len(claude_page_tasks), 1)) as variant_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as page_executor:
+        for pdf_folder in (os.listdir(img_dir) if pdf_folders is None else pdf_folders):
+            pdf_folder_path = os.path.join(img_dir, pdf_folder)
+            if not os.path.isdir(pdf_folder_path):
+                continue
+
+            tracker.start(pdf_folder)
+            failed = False
+            try:
+                # 只有 Ourswomllm 時不必讀圖
+                if page_tasks:
+                    submit_pages(iter_image_pages(pdf_folder_path), inflight, functools.partial(schedule, pdf_folder))
+            except Exception as e:
+                print(f'for "{str(pdf_folder)}" Unexpected error: {str(e)}')
+                failed = True
+            tracker.close(pdf_folder, failed=failed)
+
+    progress_bar.close()
+
+def process_pdfs(pdf_dir, ocr_text_dir, output_dir, task, save_img_dir=None, ocr_engine=None, image_preparer=None, journal=None, pdf_folders=None):
+    """
+    Streaming mode: rasterize, OCR and rewrite pages as in-memory buffers.
+
+    Pages flow PDF -> PNG bytes -> task output without touching the disk, unless
+    `save_img_dir` is given, in which case the page images are also kept there.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    pdf_files = [f for f in os.listdir(pdf_dir) if f.endswith(".pdf")]
+    if pdf_folders is not None:
+        pdf_files = [f for f in pdf_files if os.path.splitext(f)[0] in pdf_folders]
+    total_pages = sum(pdfinfo_from_path(os.path.join(pdf_dir, f))["Pages"] for f in pdf_files)
+    progress_bar = tqdm(total=total_pages, desc="Processing Pages", unit="page")
+
+    ocr_texts = load_ocr_texts(ocr_text_dir) if task != "Tess" else {}
+    ocr_pages = load_ocr_pages(ocr_text_dir) if task != "Tess" else {}
+
+    for filename in pdf_files:
+        pdf_folder = os.path.splitext(filename)[0]
+        try:
+            pdf_path = os.path.join(pdf_dir, filename)
+            save_dir = os.path.join(save_img_dir, pdf_folder) if save_img_dir else None
+            ocr_text = ocr_texts.get(pdf_folder, "")
+
+            if task == "Ourswomllm":
+                page_texts = run_document(pdf_folder, ocr_text, journal)
+                progress_bar.update(pdfinfo_from_path(pdf_path)["Pages"])
+            else:
+                input_hashes = {}
+                if journal is not None:
+                    # 頁面圖片不落地，以 PDF 內容雜湊與頁碼代表各頁圖片
+                    pdf_digest = file_sha256(pdf_path)
+                    input_hashes = {
+                        page: task_input_hash(task, f"{pdf_digest}:{page}", ocr_pages.get(pdf_folder, {}).get(page, ocr_text), image_preparer)
+                        for page in range(1, pdfinfo_from_path(pdf_path)["Pages"] + 1)
+                    }
+                done = journal.completed(pdf_folder, input_hashes) if journal is not None else {}
+                page_texts = list(done.items())
+                progress_bar.update(len(done))
+
+                pages = rasterizer.iter_pdf_pages(pdf_path, save_dir, skip_pages=done)
+                for page, response_text in rewrite_pages(pages, task, ocr_pages.get(pdf_folder, {}), ocr_text, ocr_engine, image_preparer, journal, pdf_folder, input_hashes):
+                    page_texts.append((page, response_text))
+                    progress_bar.update(1)
+                page_texts.sort(key=lambda x: x[0])
+
+            write_result(output_dir, pdf_folder, page_texts, journal)
 
         except Exception as e:
             print(f'for "{str(pdf_folder)}" Unexpected error: {str(e)}')
 
     progress_bar.close()
 
+def build_prompt(task, ocr_text):
+    """
+    (instructions, prompt) of one Claude request for `task`: the static, cacheable prefix
+    and the variable part. The page image, if any, is attached separately.
+    """
+    if task == "Ourswoocr":
+        return ourswoocrapp.INSTRUCTIONS, ourswoocrapp.build_prompt()
+    elif task == "Ourswomllm":
+        return ourswomllmapp.INSTRUCTIONS, ourswomllmapp.build_prompt(ocr_text)
+    elif task == "Oursworewrite":
+        return oursworewriteapp.INSTRUCTIONS, oursworewriteapp.build_prompt(ocr_text)
+    elif task == "Ours":
+        return oursapp.INSTRUCTIONS, oursapp.build_prompt(ocr_text)
+    else:
+        raise ValueError("Batch mode only supports the Claude tasks.")
+
+def batch_custom_id(pdf_folder, page):
+    """Deterministic custom_id of one page request, so an interrupted submission can be resumed."""
+    return "req-" + hashlib.sha256(f"{pdf_folder}/{page}".encode("utf-8")).hexdigest()[:40]
+
+def iter_batch_requests(img_dir, ocr_text_dir, task, pages, journal, image_preparer=None):
+    """
+    Yield (custom_id, [pdf, page, input_hash], request) per page (per document for Ourswomllm).
+
+    `pages` is filled with {pdf: [[page, input_hash], ...]} for every page of every PDF;
+    pages the journal already holds for the same inputs are not requested again.
+    """
+    ocr_texts = load_ocr_texts(ocr_text_dir)
+    ocr_pages = load_ocr_pages(ocr_text_dir)
+
+    for pdf_folder in os.listdir(img_dir):
+        pdf_folder_path = os.path.join(img_dir, pdf_folder)
+        if not os.path.isdir(pdf_folder_path):
+            continue
+
+        ocr_text = ocr_texts.get(pdf_folder, "")
+        pages[pdf_folder] = []
+
+        if task == "Ourswomllm":
+            document_hash = task_input_hash(task, None, ocr_text)
+            pages[pdf_folder].append([None, document_hash])
+            if journal.completed(pdf_folder, {None: document_hash}):
+                continue
+            instructions, prompt = build_prompt(task, ocr_text)
+            yield batch_custom_id(pdf_folder, None), [pdf_folder, None, document_hash], claude_batch.build_request(
+                batch_custom_id(pdf_folder, None), prompt, prefix=instructions
+            )
+            continue
+
+        for page, image_bytes in iter_image_pages(pdf_folder_path):
+            page_ocr_text = ocr_pages.get(pdf_folder, {}).get(page, ocr_text)
+            input_hash = task_input_hash(task, hashlib.sha256(image_bytes).hexdigest(), page_ocr_text, image_preparer)
+            pages[pdf_folder].append([page, input_hash])
+            if journal.completed(pdf_folder, {page: input_hash}):
+                continue
+            custom_id = batch_custom_id(pdf_folder, page)
+            image_bytes, image_media_type = prepare_image(image_bytes, image_preparer)
+            instructions, prompt = build_prompt(task, page_ocr_text)
+            yield custom_id, [pdf_folder, page, input_hash], claude_batch.build_request(
+                custom_id, prompt, image_bytes, image_media_type, instructions
+            )
+
+def pending_pdf_folders(img_dir, tasks, manifest, journals):
+    """
+    PDF folders with at least one task whose output is missing or older than the PDF.
+
+    Journal entries of a task whose PDF changed since its last output are discarded, so
+    the changed document is reprocessed from scratch rather than resumed.
+    """
+    pdf_folders = []
+    for pdf_folder in os.listdir(img_dir):
+        if not os.path.isdir(os.path.join(img_dir, pdf_folder)):
+            continue
+        stale_tasks = [task for task in tasks if not manifest.is_current(pdf_folder, task)]
+        if not stale_tasks:
+            continue
+        pdf_folders.append(pdf_folder)
+        for task in stale_tasks:
+            if manifest.has_stage(pdf_folder, task) and journals.get(task) is not None:
+                journals[task].reset(pdf_folder)
+    return pdf_folders
+
+def mark_completed(manifest, pdf_folders, output_dirs, journals, start_time):
+    """Record in the manifest every task output written (without failed pages) during this run."""
+    for pdf_folder in pdf_folders:
+        for task, output_dir in output_dirs.items():
+            txt_file_path = os.path.join(output_dir, f"{pdf_folder}.txt")
+            if not os.path.exists(txt_file_path) or os.path.getmtime(txt_file_path) < start_time:
+                continue
+            journal = journals.get(task)
+            if journal is not None and journal.failed(pdf_folder):
+                continue
+            manifest.mark(pdf_folder, task)
+    manifest.save()
+
+def process_images_batch(img_dir, ocr_text_dir, output_dir, task, journal, poll_interval=60, image_preparer=None):
+    """
+    Bulk mode: submit every request of `task` through the Message Batches API, wait for
+    the batches to finish and reassemble `{pdf}.txt` in page order.
+
+    Submitted batch ids and their custom_ids are kept in `{output_dir}/.batches.json`, so an
+    interrupted run resumes polling, and an interrupted submission only submits the requests
+    not yet in a batch. Results go through the journal: errored or expired requests are
+    recorded as failed, their PDF is not written, and a rerun resubmits only those pages.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, BATCH_STATE_FILE)
+
+    def save_state():
+        with open(state_path, "w", encoding="utf-8") as state_file:
+            json.dump(state, state_file, ensure_ascii=False)
+
+    state = {"batch_ids": [], "id_map": {}, "pages": {}, "submitted": False}
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as state_file:
+            state.update(json.load(state_file))
+
+    if not state["submitted"]:
+        if state["batch_ids"]:
+            print(f"Previous batch submission was interrupted after {len(state['batch_ids'])} batches; submitting the remaining requests.")
+        targets = {}  # custom_id -> [pdf, page, input_hash]，尚未送出的請求
+
+        def requests():
+            for custom_id, target, request in iter_batch_requests(img_dir, ocr_text_dir, task, state["pages"], journal, image_preparer):
+                if custom_id in state["id_map"]:
+                    continue  # 已包含在先前送出的 batch 中
+                targets[custom_id] = target
+                yield request
+
+        def on_submit(batch_id, custom_ids):
+            state["batch_ids"].append(batch_id)
+            for custom_id in custom_ids:
+                state["id_map"][custom_id] = targets.pop(custom_id)
+            save_state()
+
+        claude_batch.submit_batches(requests(), on_submit)
+        state["submitted"] = True
+        save_state()
+
+    claude_batch.wait_for_batches(state["batch_ids"], poll_interval)
+
+    for batch_id in state["batch_ids"]:
+        for custom_id, response_text in claude_batch.iter_results(batch_id):
+            pdf_folder, page, input_hash = state["id_map"][custom_id]
+            journal.record(pdf_folder, page, response_text, 0, input_hash=input_hash)
+
+    for pdf_folder, page_hashes in state["pages"].items():
+        input_hashes = {page: input_hash for page, input_hash in page_hashes}
+        done = journal.completed(pdf_folder, input_hashes)
+        if len(done) < len(input_hashes):
+            report_failures(journal, pdf_folder)
+            continue
+        write_result(output_dir, pdf_folder, sorted(done.items(), key=lambda x: x[0] or 0), journal)
+
+    os.remove(state_path)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process images and save as TXT")
-    parser.add_argument("--task", choices=["Tess", "Ourswoocr", "Ourswomllm", "Oursworewrite", "Ours"], required=True)
+    task_group = parser.add_mutually_exclusive_group(required=True)
+    task_group.add_argument("--task", choices=TASKS)
+    task_group.add_argument("--tasks", help="Comma-separated tasks run together in one pass over the corpus, e.g. Tess,Ours")
+    parser.add_argument("--stream", action="store_true", help="Read PDFs directly and keep page images in memory")
+    parser.add_argument("--save-images", action="store_true", help="With --stream, also write the page PNGs to IMG_DIR")
+    parser.add_argument("--batch", action="store_true", help="Submit all Claude requests through the Message Batches API")
+    parser.add_argument("--poll-interval", type=int, default=60, help="With --batch, seconds between batch status polls")
+    parser.add_argument("--workers", type=int, default=0, help="Rewrite pages from all PDFs on a thread pool of this size; 0 is sequential")
+    parser.add_argument("--max-inflight", type=int, default=None, help="With --workers, max page images held in memory (default: 2x workers)")
+    parser.add_argument("--fresh", action="store_true", help="Discard the page journal and reprocess every page")
+    parser.add_argument("--incremental", action="store_true", help="Only process PDFs that are new or changed according to the corpus manifest")
+    parser.add_argument("--ocr-workers", type=int, default=0, help="Tess only: OCR process pool size; 0 keeps OCR in-process")
+    parser.add_argument("--ocr-threads", type=int, default=1, help="Tess only: tesseract threads per OCR worker")
+    parser.add_argument("--max-edge", type=int, default=None, help="Downscale page images sent to Claude to this longest side")
+    parser.add_argument("--max-pixels", type=int, default=None, help="Downscale page images sent to Claude to this pixel count")
+    parser.add_argument("--grayscale", action="store_true", help="Convert page images sent to Claude to grayscale")
+    parser.add_argument("--image-format", choices=["PNG", "JPEG", "WEBP"], default="PNG", help="Re-encode page images sent to Claude")
+    parser.add_argument("--image-quality", type=int, default=85, help="JPEG/WEBP quality")
     args = parser.parse_args()
+    if args.incremental and args.batch:
+        parser.error("--incremental cannot be combined with --batch")
+    if args.tasks and (args.stream or args.batch or args.ocr_workers):
+        parser.error("--tasks cannot be combined with --stream, --batch or --ocr-workers")
+    # 執行模式互斥，不讓某個選項默默覆蓋另一個
+    if args.batch and (args.stream or args.workers or args.ocr_workers):
+        parser.error("--batch cannot be combined with --stream, --workers or --ocr-workers")
+    if args.workers and (args.stream or args.ocr_workers):
+        parser.error("--workers cannot be combined with --stream or --ocr-workers")
+    if args.save_images and not args.stream:
+        parser.error("--save-images requires --stream")
+    if args.max_inflight and not (args.workers or args.tasks):
+        parser.error("--max-inflight requires --workers or --tasks")
 
-    output_dir = f"result/{args.task}"
+    start_time = time.time()
+    manifest = None
+    if args.incremental:
+        manifest = CorpusManifest()
+        manifest.refresh(PDF_DIR)
 
-    process_images(IMG_DIR, OCR_TEXT_DIR, output_dir, args.task)
-    print(f"Results saved in folder: {output_dir}")
+    image_preparer = None
+    if args.max_edge or args.max_pixels or args.grayscale or args.image_format != "PNG":
+        image_preparer = ImagePreparer(args.max_edge, args.max_pixels, args.grayscale, args.image_format, args.image_quality)
+
+    if args.tasks:
+        tasks = [task.strip() for task in args.tasks.split(",") if task.strip()]
+        invalid = [task for task in tasks if task not in TASKS]
+        if invalid:
+            parser.error(f"invalid tasks: {', '.join(invalid)} (choose from {', '.join(TASKS)})")
+
+        output_dirs = {task: f"result/{task}" for task in tasks}
+        journals = {task: PageJournal(os.path.join(output_dirs[task], JOURNAL_FILE), fresh=args.fresh) for task in tasks}
+        pdf_folders = pending_pdf_folders(IMG_DIR, tasks, manifest, journals) if manifest is not None else None
+        try:
+            process_images_multi(IMG_DIR, OCR_TEXT_DIR, output_dirs, max(args.workers, 1), args.max_inflight, image_preparer, journals, pdf_folders)
+        finally:
+            if manifest is not None:
+                mark_completed(manifest, pdf_folders, output_dirs, journals, start_time)
+            for journal in journals.values():
+                journal.close()
+        if image_preparer is not None:
+            print(image_preparer.report())
+        print(f"Claude usage: {call_ai.stats()}")
+        print(f"Results saved in folders: {', '.join(output_dirs.values())}")
+    else:
+        output_dir = f"result/{args.task}"
+
+        ocr_engine = None
+        if args.task == "Tess" and args.ocr_workers > 0:
+            ocr_engine = tessocrapp.TessOCREngine(workers=args.ocr_workers, threads_per_worker=args.ocr_threads)
+
+        # 逐頁紀錄結果，中斷後重跑只處理尚未完成或失敗的頁面
+        journal = PageJournal(os.path.join(output_dir, JOURNAL_FILE), fresh=args.fresh)
+
+        # 以 manifest 篩選出需要處理的 PDF（串流模式下改以 PDF 目錄為準）
+        pdf_folders = None
+        if manifest is not None:
+            if args.stream:
+                pdf_folders = [pid for pid in manifest.pdfs if not manifest.is_current(pid, args.task)]
+                for pid in pdf_folders:
+                    if manifest.has_stage(pid, args.task):
+                        journal.reset(pid)
+            else:
+                pdf_folders = pending_pdf_folders(IMG_DIR, [args.task], manifest, {args.task: journal})
+
+        try:
+            if args.batch:
+                process_images_batch(IMG_DIR, OCR_TEXT_DIR, output_dir, args.task, journal, args.poll_interval, image_preparer)
+            elif args.workers > 0:
+                process_images_concurrent(IMG_DIR, OCR_TEXT_DIR, output_dir, args.task, args.workers, args.max_inflight, image_preparer, journal, pdf_folders)
+            elif args.stream:
+                process_pdfs(PDF_DIR, OCR_TEXT_DIR, output_dir, args.task, IMG_DIR if args.save_images else None, ocr_engine, image_preparer, journal, pdf_folders)
+            else:
+                process_images(IMG_DIR, OCR_TEXT_DIR, output_dir, args.task, ocr_engine, image_preparer, journal, pdf_folders)
+        finally:
+            if ocr_engine is not None:
+                ocr_engine.close()
+            if manifest is not None:
+                mark_completed(manifest, pdf_folders, {args.task: output_dir}, {args.task: journal}, start_time)
+            if journal is not None:
+                journal.close()
+        if image_preparer is not None:
+            print(image_preparer.report())
+        if args.task != "Tess" and not args.batch:
+            print(f"Claude usage: {call_ai.stats()}")
+        print(f"Results saved in folder: {output_dir}")
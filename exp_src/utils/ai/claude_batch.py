@@ -0,0 +1,79 @@
+import json
+import time
+import utils.ai.claude_tem as call_ai
+
+logger = call_ai.logger
+
+# Message Batches API 上限為 100,000 筆請求 / 256 MB，保留部分餘裕
+MAX_BATCH_REQUESTS = 100000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+
+def build_request(custom_id, prompt, image_bytes=None, image_media_type="image/png", prefix=None):
+    """One Message Batches request with the same payload `template` would send."""
+    return {
+        "custom_id": custom_id,
+        "params": {
+            "model": call_ai.MODEL,
+            "max_tokens": call_ai.MAX_TOKENS,
+            "messages": call_ai.build_messages(prompt, image_bytes, image_media_type, prefix),
+        },
+    }
+
+
+def submit_batches(requests, on_submit=None, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """
+    Submit an iterable of requests as one or more batches, respecting the size limits.
+
+    Requests are consumed lazily, so only one batch worth of payload is held in memory.
+    `on_submit(batch_id, custom_ids)` is called after each batch is created. Returns the batch ids.
+    """
+    client = call_ai.get_client()
+    batch_ids = []
+    chunk = []
+    chunk_bytes = 0
+
+    def flush():
+        batch = client.messages.batches.create(requests=chunk)
+        logger.info(f"Submitted batch {batch.id} with {len(chunk)} requests")
+        batch_ids.append(batch.id)
+        if on_submit:
+            on_submit(batch.id, [request["custom_id"] for request in chunk])
+
+    for request in requests:
+        size = len(json.dumps(request))
+        if chunk and (len(chunk) >= max_requests or chunk_bytes + size > max_bytes):
+            flush()
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(request)
+        chunk_bytes += size
+
+    if chunk:
+        flush()
+    return batch_ids
+
+
+def wait_for_batches(batch_ids, poll_interval=60):
+    """Poll until every batch has finished processing."""
+    client = call_ai.get_client()
+    pending = set(batch_ids)
+    while pending:
+        for batch_id in list(pending):
+            batch = client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                pending.discard(batch_id)
+        if pending:
+            logger.info(f"Waiting for {len(pending)} of {len(batch_ids)} batches")
+            time.sleep(poll_interval)
+
+
+def iter_results(batch_id):
+    """Yield (custom_id, text) for a finished batch; failed requests yield "ERROR" like `template`."""
+    client = call_ai.get_client()
+    for entry in client.messages.batches.results(batch_id):
+        if entry.result.type == "succeeded":
+            yield entry.custom_id, entry.result.message.content[0].text
+        else:
+            logger.error(f"Batch request {entry.custom_id} {entry.result.type}")
+            yield entry.custom_id, "ERROR"
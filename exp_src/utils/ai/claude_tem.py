@@ -1,30 +1,217 @@
 import anthropic
+import asyncio
 import base64
 import httpx
 import textwrap
+import threading
 import utils.config_log as config_log
+import utils.ai.response_cache as response_cache
 import time  # 用來做延遲
 
 config, logger, CONFIG_PATH = config_log.setup_config_and_logging()
 config.read(CONFIG_PATH)
 
-def template(prompt, image_bytes=None, image_media_type="image/png", max_retries=5):
+MODEL = "claude-3-7-sonnet-20250219"
+MAX_TOKENS = 8192
+IMAGE_TOKEN_ESTIMATE = 1600  # 單張頁面圖片的 token 粗估值，實際用量於回應後校正
+
+
+class RateLimiter:
     """
-    Sends a text prompt and optionally an image to Claude 3.7 Sonnet API with exponential backoff.
+    Process-wide admission control shared by `template` and `atemplate`.
 
-    :param prompt: The text prompt to send.
-    :param image_bytes: Optional image data in bytes.
-    :param image_media_type: The media type of the image (default: "image/png").
-    :param max_retries: Maximum number of retry attempts (default: 5).
-    :return: Claude's response or "ERROR" on failure.
+    Combines a global concurrency limit with token buckets for requests/min and
+    tokens/min (0 disables a bucket). A `retry-after` from the API pauses every caller.
     """
-    api_key = config.get('Claude', 'api_key')
-    userprompt = textwrap.dedent(prompt).strip()
 
-    client = anthropic.Anthropic(api_key=api_key)
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.lock = threading.Lock()
+        self.request_allowance = float(requests_per_minute)
+        self.token_allowance = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.requests_per_minute:
+            self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def _try_acquire(self, tokens):
+        """Take a slot if possible; otherwise return how many seconds to wait before retrying."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                return 0.05
+            if self.requests_per_minute and self.request_allowance < 1:
+                return (1 - self.request_allowance) * 60 / self.requests_per_minute
+            # 單次請求超過整個 bucket 時，只要求 bucket 全滿，避免永遠等待
+            tokens = min(tokens, self.tokens_per_minute)
+            if self.tokens_per_minute and self.token_allowance < tokens:
+                return (tokens - self.token_allowance) * 60 / self.tokens_per_minute
+            if self.requests_per_minute:
+                self.request_allowance -= 1
+            if self.tokens_per_minute:
+                self.token_allowance -= tokens
+            self.in_flight += 1
+            return 0
+
+    def acquire(self, tokens):
+        with self.lock:
+            self.queued += 1
+        try:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait <= 0:
+                    return
+                time.sleep(min(wait, 1))
+        finally:
+            with self.lock:
+                self.queued -= 1
+
+    async def acquire_async(self, tokens):
+        with self.lock:
+            self.queued += 1
+        try:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(min(wait, 1))
+        finally:
+            with self.lock:
+                self.queued -= 1
+
+    def release(self, estimated_tokens, used_tokens=None, failed=False):
+        """Free the concurrency slot and correct the token bucket with the actual usage."""
+        with self.lock:
+            self.in_flight -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+            if used_tokens is not None and self.tokens_per_minute:
+                self.token_allowance -= used_tokens - min(estimated_tokens, self.tokens_per_minute)
+
+    def block_for(self, seconds):
+        with self.lock:
+            self.rate_limited += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rate_limited": self.rate_limited,
+            }
+
+
+limiter = RateLimiter(
+    max_concurrency=config.getint('Claude', 'max_concurrency', fallback=8),
+    requests_per_minute=config.getint('Claude', 'requests_per_minute', fallback=50),
+    tokens_per_minute=config.getint('Claude', 'tokens_per_minute', fallback=0),
+)
+
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+_response_cache = None
+_usage_lock = threading.Lock()
+usage = {
+    "input_tokens": 0,
+    "cache_creation_input_tokens": 0,
+    "cache_read_input_tokens": 0,
+    "output_tokens": 0,
+}
+
+
+def base_url():
+    """Optional API endpoint override (e.g. a local stand-in server); None uses the default."""
+    return config.get('Claude', 'base_url', fallback=None) or None
+
+
+def get_client():
+    """Long-lived Claude client, so every call reuses the same HTTP connection pool."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            # 重試由 template 控制（會遵守 retry-after），因此關閉 SDK 內建重試
+            _client = anthropic.Anthropic(api_key=config.get('Claude', 'api_key'), base_url=base_url(), max_retries=0)
+        return _client
+
+
+def get_async_client():
+    """Long-lived async Claude client for `atemplate`."""
+    global _async_client
+    with _client_lock:
+        if _async_client is None:
+            _async_client = anthropic.AsyncAnthropic(api_key=config.get('Claude', 'api_key'), base_url=base_url(), max_retries=0)
+        return _async_client
+
+
+def get_response_cache():
+    """Opt-in response cache, enabled with `response_cache = true` under [Claude]."""
+    global _response_cache
+    with _client_lock:
+        if _response_cache is None:
+            _response_cache = response_cache.ResponseCache(
+                path=config.get('Claude', 'response_cache_path', fallback=response_cache.RESPONSE_CACHE_PATH),
+                max_bytes=config.getint('Claude', 'response_cache_max_mb', fallback=1024) * 1024 * 1024,
+            )
+        return _response_cache
+
+
+def cache_enabled(use_cache):
+    return config.getboolean('Claude', 'response_cache', fallback=False) if use_cache is None else use_cache
+
+
+def record_usage(response):
+    """Accumulate token usage, including prompt-cache writes and hits."""
+    with _usage_lock:
+        for key in usage:
+            usage[key] += getattr(response.usage, key, None) or 0
+
+
+def stats():
+    """Queue depth, in-flight count, rate-limit counters and token usage (incl. cache hits)."""
+    with _usage_lock:
+        return {**limiter.stats(), **usage}
+
+
+def build_messages(prompt, image_bytes=None, image_media_type="image/png", prefix=None):
+    """
+    Build the Messages API payload for a text prompt and an optional image.
+
+    A static `prefix` goes first and is marked for provider-side prompt caching, so the
+    variable image and prompt that follow do not invalidate it.
+    """
+    userprompt = textwrap.dedent(prompt).strip()
 
     messages = [{"role": "user", "content": []}]
 
+    if prefix:
+        messages[0]["content"].append({
+            "type": "text",
+            "text": textwrap.dedent(prefix).strip(),
+            "cache_control": {"type": "ephemeral"}
+        })
+
     if image_bytes:
         encoded_image = base64.b64encode(image_bytes).decode("utf-8")
         messages[0]["content"].append({
@@ -36,29 +223,166 @@ def template(prompt, image_bytes=None, image_media_type="image/png", max_retries
             }
         })
 
-    messages[0]["content"].append({"type": "text", "text": userprompt})
+    if userprompt:
+        messages[0]["content"].append({"type": "text", "text": userprompt})
+    return messages
 
-    retry_count = 0
-    backoff = 1  # 初始回退時間為 1 秒
 
-    while retry_count < max_retries:
+def estimate_tokens(prompt, image_bytes=None, prefix=None):
+    """Rough input token estimate used to admit a request before its real usage is known."""
+    return len(prompt) + len(prefix or "") + (IMAGE_TOKEN_ESTIMATE if image_bytes else 0)
+
+
+def used_tokens(response):
+    return response.usage.input_tokens + response.usage.output_tokens
+
+
+def retry_after(error):
+    """Seconds requested by the API's `retry-after` header, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def cache_key(prompt, image_bytes, image_media_type, prefix, use_cache):
+    """Response cache key of a request, or None when the cache is not used."""
+    if not cache_enabled(use_cache):
+        return None
+    return response_cache.ResponseCache.make_key(MODEL, MAX_TOKENS, prompt, image_bytes, image_media_type, prefix)
+
+
+def cached_response(key, refresh=False):
+    if key is None or refresh:
+        return None
+    return get_response_cache().get(key)
+
+
+def store_response(key, response_text):
+    # 失敗的 "ERROR" 回應不可寫入快取
+    if key is not None and response_text != "ERROR":
+        get_response_cache().put(key, response_text)
+
+
+def read_response(response, estimated_tokens):
+    """Release the attempt's limiter slot with its actual usage and return the response text."""
+    try:
+        tokens = used_tokens(response)
+    except Exception:
+        tokens = None
+    # 每次 acquire 只 release 一次；之後讀取回應時的例外不再 release
+    limiter.release(estimated_tokens, tokens)
+    try:
+        record_usage(response)
+        return response.content[0].text
+    except Exception as e:
+        logger.error(f"Unexpected Claude API response: {e}")
+        return "ERROR"
+
+
+def retry_delay(error, attempt, max_retries):
+    """Seconds to wait before retrying a failed attempt (0-based `attempt`); None to give up."""
+    if not isinstance(error, (httpx.TimeoutException, anthropic.APIError)):
+        logger.error(f"Unexpected Claude API error: {error}")
+        return None
+    logger.error(f"Claude API error (attempt {attempt + 1}): {error}")
+    if attempt + 1 >= max_retries:
+        return None
+    wait = retry_after(error)
+    if wait is not None:
+        # retry-after 暫停所有呼叫端，由下一次 acquire 等待
+        limiter.block_for(wait)
+        return 0
+    return 2 ** attempt  # 指數回退 (1s, 2s, 4s, 8s, ...)
+
+
+def template(prompt, image_bytes=None, image_media_type="image/png", max_retries=5, use_cache=None, refresh=False, prefix=None):
+    """
+    Sends a text prompt and optionally an image to Claude 3.7 Sonnet API with exponential backoff.
+
+    :param prompt: The text prompt to send.
+    :param image_bytes: Optional image data in bytes.
+    :param image_media_type: The media type of the image (default: "image/png").
+    :param max_retries: Maximum number of retry attempts (default: 5).
+    :param use_cache: Use the response cache; None follows the config (default: None).
+    :param refresh: Skip the cache lookup but still store the new response (default: False).
+    :param prefix: Static instructions sent before the image and prompt, marked for prompt caching.
+    :return: Claude's response or "ERROR" on failure.
+    """
+    key = cache_key(prompt, image_bytes, image_media_type, prefix, use_cache)
+    cached = cached_response(key, refresh)
+    if cached is not None:
+        return cached
+
+    text = _template(prompt, image_bytes, image_media_type, max_retries, prefix)
+    store_response(key, text)
+    return text
+
+
+def _template(prompt, image_bytes, image_media_type, max_retries, prefix=None):
+    messages = build_messages(prompt, image_bytes, image_media_type, prefix)
+    estimated_tokens = estimate_tokens(prompt, image_bytes, prefix)
+    client = get_client()
+
+    for attempt in range(max_retries):
+        limiter.acquire(estimated_tokens)
         try:
             response = client.messages.create(
-                model="claude-3-7-sonnet-20250219",
-                max_tokens=8192,
+                model=MODEL,
+                max_tokens=MAX_TOKENS,
                 messages=messages
             )
-            return response.content[0].text  # 成功則回傳回應
-        except (httpx.TimeoutException, anthropic.APIError) as e:
-            logger.error(f"Claude API error (attempt {retry_count + 1}): {e}")
-            retry_count += 1
-            if retry_count >= max_retries:
+        except Exception as e:
+            limiter.release(estimated_tokens, failed=True)
+            wait = retry_delay(e, attempt, max_retries)
+            if wait is None:
                 return "ERROR"
-            time.sleep(backoff)
-            backoff *= 2  # 指數回退 (1s, 2s, 4s, 8s, ...)
+            time.sleep(wait)
+            continue
+        return read_response(response, estimated_tokens)
+
+    return "ERROR"
+
+
+async def atemplate(prompt, image_bytes=None, image_media_type="image/png", max_retries=5, use_cache=None, refresh=False, prefix=None):
+    """
+    Async counterpart of `template`, sharing its rate limiter, retry policy and response cache.
+
+    :return: Claude's response or "ERROR" on failure.
+    """
+    key = cache_key(prompt, image_bytes, image_media_type, prefix, use_cache)
+    cached = cached_response(key, refresh)
+    if cached is not None:
+        return cached
+
+    text = await _atemplate(prompt, image_bytes, image_media_type, max_retries, prefix)
+    store_response(key, text)
+    return text
+
 
+async def _atemplate(prompt, image_bytes, image_media_type, max_retries, prefix=None):
+    messages = build_messages(prompt, image_bytes, image_media_type, prefix)
+    estimated_tokens = estimate_tokens(prompt, image_bytes, prefix)
+    client = get_async_client()
+
+    for attempt in range(max_retries):
+        await limiter.acquire_async(estimated_tokens)
+        try:
+            response = await client.messages.create(
+                model=MODEL,
+                max_tokens=MAX_TOKENS,
+                messages=messages
+            )
         except Exception as e:
-            logger.error(f"Unexpected Claude API error: {e}")
-            return "ERROR"
+            limiter.release(estimated_tokens, failed=True)
+            wait = retry_delay(e, attempt, max_retries)
+            if wait is None:
+                return "ERROR"
+            await asyncio.sleep(wait)
+            continue
+        return read_response(response, estimated_tokens)
 
     return "ERROR"
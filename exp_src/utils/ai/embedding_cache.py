@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from array import array
+from langchain.embeddings import OpenAIEmbeddings
+
+EMBEDDING_CACHE_PATH = "data/cache/embedding_cache.sqlite"
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 3072
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by model, dimensions and the SHA-256 of the text.
+
+    Vectors are stored as float32 blobs, so identical chunks shared by several
+    variants or re-ingested after a schema change are only embedded once.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model, dimensions, text):
+        payload = f"{model}\0{dimensions}\0{text}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_many(self, keys):
+        """{key: vector} for the keys that are cached."""
+        found = {}
+        keys = list(set(keys))
+        with self.lock:
+            # SQLite 單一查詢的參數數量有限，分段查詢
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+        return found
+
+    def put_many(self, vectors):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in vectors.items()],
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class BatchEmbedder:
+    """
+    Client-side embedding of chunk texts in large batches.
+
+    Texts already in the cache are served from disk; the rest are sent to the
+    OpenAI embeddings API `batch_size` texts per request and then cached.
+    """
+
+    def __init__(self, api_key=None, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS, batch_size=256, cache=None):
+        self.model = model
+        self.dimensions = dimensions
+        self.embeddings = OpenAIEmbeddings(
+            model=model, dimensions=dimensions, chunk_size=batch_size, openai_api_key=api_key
+        )
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, texts):
+        """Return one vector per text, in order."""
+        keys = [EmbeddingCache.make_key(self.model, self.dimensions, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), embedded))
+            self.cache.put_many(new_vectors)
+            vectors.update(new_vectors)
+
+        with self.lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        return [vectors[key] for key in keys]
+
+    def report(self):
+        with self.lock:
+            total = self.hits + self.misses
+            ratio = self.hits / total if total else 0
+            return f"Embeddings: {total} texts, {self.misses} embedded, {self.hits} from cache ({ratio:.1%})"
@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import textwrap
+import threading
+
+RESPONSE_CACHE_PATH = "data/cache/claude_responses.sqlite"
+
+
+class ResponseCache:
+    """
+    Persistent Claude response cache with size-bounded LRU eviction.
+
+    Keys cover everything that determines the response: model, max_tokens, the
+    normalized prefix and prompt and the SHA-256 of the attached image.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model, max_tokens, prompt, image_bytes=None, image_media_type=None, prefix=None):
+        payload = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "prefix": textwrap.dedent(prefix).strip() if prefix else None,
+            "prompt": textwrap.dedent(prompt).strip(),
+            "image": hashlib.sha256(image_bytes).hexdigest() if image_bytes else None,
+            "media_type": image_media_type if image_bytes else None,
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode("utf-8"))
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in `max_bytes`."""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def candidate_scores(vector_results, bm25_results):
+    """
+    Per-pid (vector_score, bm25_score) exactly as `WeaviateHybridSearch.hybrid_search` merges them.
+
+    `*_results` are [(pid, score), ...] in the order Weaviate returned them. A later hit
+    of the same pid overwrites an earlier one and pids keep their first-seen order,
+    which decides ties when the fused scores are sorted.
+    """
+    scores = {}
+    for pid, score in vector_results:
+        scores[pid] = [float(score), 0.0]
+    for pid, score in bm25_results:
+        if pid in scores:
+            scores[pid][1] = float(score)
+        else:
+            scores[pid] = [0.0, float(score)]
+    return list(scores), np.array([s[0] for s in scores.values()]), np.array([s[1] for s in scores.values()])
+
+
+class AlphaSweep:
+    """
+    Evaluate AP@1 and MRR (top-3) for any number of alphas from cached candidate scores.
+
+    Candidates of all questions are padded into (questions, candidates) matrices, so each
+    alpha costs a few vectorized NumPy operations instead of a retrieval pass.
+    """
+
+    def __init__(self, questions, top_k=3):
+        """`questions`: [(vector_results, bm25_results, expected_pid), ...]"""
+        self.top_k = top_k
+        merged = [candidate_scores(vector_results, bm25_results) for vector_results, bm25_results, _ in questions]
+        width = max([len(pids) for pids, _, _ in merged] + [1])
+
+        self.vector = np.zeros((len(merged), width))
+        self.bm25 = np.zeros((len(merged), width))
+        self.valid = np.zeros((len(merged), width), dtype=bool)
+        self.expected = np.full(len(merged), -1)
+        for row, ((pids, vector, bm25), (_, _, expected)) in enumerate(zip(merged, questions)):
+            self.vector[row, :len(pids)] = vector
+            self.bm25[row, :len(pids)] = bm25
+            self.valid[row, :len(pids)] = True
+            pid_strs = [str(pid) for pid in pids]
+            if str(expected) in pid_strs:
+                self.expected[row] = pid_strs.index(str(expected))
+
+    def ranks(self, alpha):
+        """0-based rank of the expected pid per question (-1 when it was not retrieved)."""
+        scores = alpha * self.vector + (1 - alpha) * self.bm25
+        rows = np.arange(len(self.expected))
+        found = self.expected >= 0
+        expected_scores = scores[rows, np.maximum(self.expected, 0)][:, None]
+        # 穩定排序下，分數相同時較早出現的 pid 排在前面
+        earlier = np.arange(scores.shape[1])[None, :] < self.expected[:, None]
+        ahead = self.valid & ((scores > expected_scores) | ((scores == expected_scores) & earlier))
+        return np.where(found, ahead.sum(axis=1), -1)
+
+    def evaluate(self, alphas):
+        """{alpha: {'AP@1': ..., 'MRR': ...}} over all questions."""
+        results = {}
+        total = len(self.expected)
+        for alpha in alphas:
+            ranks = self.ranks(alpha)
+            hit = (ranks >= 0) & (ranks < self.top_k)
+            ap1 = float(np.sum(ranks == 0)) / total if total else 0
+            mrr = float(np.sum(np.where(hit, 1.0 / (np.maximum(ranks, 0) + 1), 0.0))) / total if total else 0
+            results[float(alpha)] = {'AP@1': ap1, 'MRR': mrr}
+        return results
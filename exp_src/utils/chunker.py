@@ -0,0 +1,74 @@
+import threading
+import tiktoken
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# text-embedding-3-large 使用 cl100k_base，單次輸入上限 8191 tokens
+EMBEDDING_ENCODING = "cl100k_base"
+EMBEDDING_MAX_TOKENS = 8191
+
+
+class TokenChunker:
+    """
+    Token-aware replacement for the character-based `RecursiveCharacterTextSplitter`.
+
+    Chunks are measured with the embedding model's tiktoken encoding, so every chunk fits
+    `max_tokens`; the rare chunk the recursive splitter leaves oversized is cut into token
+    windows. Token counts of all chunks are kept for a distribution report.
+    """
+
+    def __init__(self, chunk_tokens=8000, overlap_tokens=500, max_tokens=EMBEDDING_MAX_TOKENS, encoding_name=EMBEDDING_ENCODING):
+        if chunk_tokens > max_tokens:
+            raise ValueError(f"chunk_tokens ({chunk_tokens}) exceeds the model limit ({max_tokens})")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.max_tokens = max_tokens
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name=encoding_name, chunk_size=chunk_tokens, chunk_overlap=overlap_tokens
+        )
+        self.lock = threading.Lock()
+        self.token_counts = []
+        self.resplit = 0
+
+    def _split_tokens(self, tokens):
+        """將超長 chunk 依 token 視窗切開（保留 overlap）"""
+        step = max(1, self.chunk_tokens - self.overlap_tokens)
+        starts = range(0, max(1, len(tokens) - self.overlap_tokens), step)
+        return [self.encoding.decode(tokens[start:start + self.chunk_tokens]) for start in starts]
+
+    def split_text(self, text):
+        chunks = []
+        counts = []
+        resplit = 0
+        for chunk in self.splitter.split_text(text):
+            tokens = self.encoding.encode(chunk)
+            if len(tokens) <= self.max_tokens:
+                chunks.append(chunk)
+                counts.append(len(tokens))
+                continue
+            resplit += 1
+            for piece in self._split_tokens(tokens):
+                chunks.append(piece)
+                counts.append(len(self.encoding.encode(piece)))
+
+        with self.lock:
+            self.token_counts.extend(counts)
+            self.resplit += resplit
+        return chunks
+
+    def report(self):
+        """Chunk token distribution of everything split so far."""
+        with self.lock:
+            counts = sorted(self.token_counts)
+            resplit = self.resplit
+        if not counts:
+            return "Chunks: none"
+
+        def percentile(p):
+            return counts[min(len(counts) - 1, int(len(counts) * p))]
+
+        return (
+            f"Chunks: {len(counts)}, tokens min {counts[0]} / p50 {percentile(0.5)} / p95 {percentile(0.95)} / "
+            f"max {counts[-1]} (mean {sum(counts) / len(counts):.0f}, limit {self.max_tokens}), "
+            f"{resplit} oversized chunks re-split"
+        )
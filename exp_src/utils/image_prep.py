@@ -0,0 +1,85 @@
+import time
+import threading
+from io import BytesIO
+from PIL import Image
+
+MEDIA_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class ImagePreparer:
+    """
+    Shrink page images before they are base64-encoded for MLLM calls.
+
+    Pages are downscaled to fit `max_edge` (longest side) and/or `max_pixels`,
+    optionally converted to grayscale and re-encoded as PNG, JPEG or WEBP.
+    A running size/latency report is kept across calls.
+    """
+
+    def __init__(self, max_edge=None, max_pixels=None, grayscale=False, image_format="PNG", quality=85):
+        if image_format not in MEDIA_TYPES:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.max_edge = max_edge
+        self.max_pixels = max_pixels
+        self.grayscale = grayscale
+        self.image_format = image_format
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def settings(self):
+        """The preparation settings, e.g. as part of a cache or journal key."""
+        return (
+            f"max_edge={self.max_edge};max_pixels={self.max_pixels};grayscale={self.grayscale};"
+            f"format={self.image_format};quality={self.quality}"
+        )
+
+    def target_size(self, width, height):
+        scale = 1.0
+        if self.max_edge and max(width, height) > self.max_edge:
+            scale = min(scale, self.max_edge / max(width, height))
+        if self.max_pixels and width * height > self.max_pixels:
+            scale = min(scale, (self.max_pixels / (width * height)) ** 0.5)
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def prepare(self, image_bytes):
+        """Return (prepared_bytes, media_type) for one page image."""
+        start_time = time.time()
+
+        image = Image.open(BytesIO(image_bytes))
+        size = self.target_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        if self.grayscale:
+            image = image.convert("L")
+        elif self.image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        buffer = BytesIO()
+        if self.image_format == "PNG":
+            image.save(buffer, "PNG", optimize=True)
+        else:
+            image.save(buffer, self.image_format, quality=self.quality)
+        prepared = buffer.getvalue()
+
+        with self.lock:
+            self.pages += 1
+            self.bytes_in += len(image_bytes)
+            self.bytes_out += len(prepared)
+            self.seconds += time.time() - start_time
+
+        return prepared, MEDIA_TYPES[self.image_format]
+
+    def report(self):
+        """One-line summary of the images prepared so far."""
+        with self.lock:
+            if not self.pages:
+                return "Image prep: no pages prepared"
+            ratio = self.bytes_out / self.bytes_in if self.bytes_in else 0
+            return (
+                f"Image prep: {self.pages} pages, {self.bytes_in / 1024 / 1024:.1f} MB -> "
+                f"{self.bytes_out / 1024 / 1024:.1f} MB ({ratio:.1%}), "
+                f"{self.seconds / self.pages * 1000:.1f} ms/page"
+            )
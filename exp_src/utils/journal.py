@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class PageJournal:
+    """
+    Append-only JSONL journal of per-page results for one preprocessing task.
+
+    Every attempt appends one line with the page's status, output and timing; the latest
+    line for a page wins when the journal is loaded again. A run can therefore resume
+    exactly where a previous one stopped and retry only the pages that failed.
+
+    Each entry also stores a hash of the inputs that produced it (page image, OCR text,
+    prompt and model); a page whose inputs changed since then is not reused.
+    """
+
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}  # pdf_folder -> {page: entry}
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if fresh and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 程式中斷時最後一行可能只寫了一半，忽略即可
+                    continue
+                if entry.get("status") == "reset":
+                    self.entries.pop(entry["pdf"], None)
+                    continue
+                self.entries.setdefault(entry["pdf"], {})[entry["page"]] = entry
+
+    @staticmethod
+    def is_error(output):
+        """`template` returns "ERROR" and `tessocr` returns "Error: ..." instead of raising."""
+        return output is None or output == "ERROR" or output.startswith("Error:")
+
+    @staticmethod
+    def input_hash(*parts):
+        """SHA-256 over the inputs of one result, e.g. image digest, OCR text, prompt and model."""
+        sha = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            # 先對各部分分別取雜湊，避免不同的切分方式得到相同的串接結果
+            sha.update(hashlib.sha256(part or b"").digest())
+        return sha.hexdigest()
+
+    def record(self, pdf_folder, page, output, seconds, error=None, input_hash=None):
+        status = "failed" if error is not None or self.is_error(output) else "ok"
+        entry = {
+            "pdf": pdf_folder,
+            "page": page,
+            "status": status,
+            "input_hash": input_hash,
+            "output": output,
+            "error": error,
+            "seconds": round(seconds, 3),
+            "time": time.time(),
+        }
+        with self.lock:
+            self.entries.setdefault(pdf_folder, {})[page] = entry
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def reset(self, pdf_folder):
+        """Forget every page of `pdf_folder`, e.g. after its PDF changed."""
+        entry = {"pdf": pdf_folder, "page": None, "status": "reset", "time": time.time()}
+        with self.lock:
+            self.entries.pop(pdf_folder, None)
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def completed(self, pdf_folder, input_hashes):
+        """
+        {page: output} of the pages of `pdf_folder` that already succeeded with the same inputs.
+
+        `input_hashes` is {page: input_hash} of the current inputs; entries recorded from
+        other inputs (or without a hash) are ignored, so those pages are processed again.
+        """
+        with self.lock:
+            entries = self.entries.get(pdf_folder, {})
+            return {
+                page: entry["output"] for page, entry in entries.items()
+                if entry["status"] == "ok" and entry.get("input_hash") is not None
+                and entry.get("input_hash") == input_hashes.get(page)
+            }
+
+    def failed(self, pdf_folder):
+        """Pages of `pdf_folder` whose latest attempt failed."""
+        with self.lock:
+            entries = self.entries.get(pdf_folder, {})
+            return [page for page, entry in entries.items() if entry["status"] != "ok"]
+
+    def close(self):
+        self.file.close()
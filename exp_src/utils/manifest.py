@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import threading
+
+MANIFEST_PATH = "data/esun_dataset/reference/corpus_manifest.json"
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class CorpusManifest:
+    """
+    Corpus manifest used for incremental re-ingestion.
+
+    Maps every PDF (by its name without extension, the `pid`) to its size, mtime, content
+    hash and page count, plus the input fingerprint each stage last produced output from
+    (`images`, a rewrite task such as `Ours`, or `db:{task}`). A stage is current for a PDF
+    when its recorded fingerprint matches the present one, so only new or changed
+    documents are touched again.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pdfs = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.pdfs = json.load(f).get("pdfs", {})
+
+    def refresh(self, pdf_dir):
+        """
+        Rescan `pdf_dir`; PDFs whose size and mtime are unchanged are not re-hashed.
+        Returns the pids that are new or whose content changed.
+        """
+        changed = []
+        seen = set()
+        for filename in os.listdir(pdf_dir):
+            if not filename.endswith(".pdf"):
+                continue
+            pid = os.path.splitext(filename)[0]
+            seen.add(pid)
+            path = os.path.join(pdf_dir, filename)
+            stat = os.stat(path)
+
+            with self.lock:
+                entry = self.pdfs.get(pid)
+                if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                    continue
+
+            sha256 = file_sha256(path)
+            with self.lock:
+                if entry is None or entry["sha256"] != sha256:
+                    changed.append(pid)
+                    # 保留舊的 stage 紀錄：指紋不再相符即視為過期，且下游可據此清除舊輸出
+                    stages = entry["stages"] if entry else {}
+                    entry = {"file": filename, "sha256": sha256, "pages": None, "stages": stages}
+                entry.update({"size": stat.st_size, "mtime": stat.st_mtime})
+                self.pdfs[pid] = entry
+
+        with self.lock:
+            for pid in set(self.pdfs) - seen:
+                del self.pdfs[pid]
+        return changed
+
+    def fingerprint(self, pid):
+        """Default stage input fingerprint: the PDF content hash."""
+        with self.lock:
+            entry = self.pdfs.get(pid)
+            return entry["sha256"] if entry else None
+
+    def is_current(self, pid, stage, fingerprint=None):
+        fingerprint = fingerprint or self.fingerprint(pid)
+        with self.lock:
+            entry = self.pdfs.get(pid)
+            return bool(entry) and fingerprint is not None and entry["stages"].get(stage) == fingerprint
+
+    def has_stage(self, pid, stage):
+        """True when `stage` ran for `pid` before, whether or not it is still current."""
+        with self.lock:
+            entry = self.pdfs.get(pid)
+            return bool(entry) and stage in entry["stages"]
+
+    def mark(self, pid, stage, fingerprint=None):
+        fingerprint = fingerprint or self.fingerprint(pid)
+        with self.lock:
+            entry = self.pdfs.setdefault(pid, {"file": None, "sha256": None, "size": None, "mtime": None, "pages": None, "stages": {}})
+            entry["stages"][stage] = fingerprint
+
+    def set_pages(self, pid, pages):
+        with self.lock:
+            if pid in self.pdfs:
+                self.pdfs[pid]["pages"] = pages
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"pdfs": self.pdfs}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,86 @@
+import threading
+
+
+def submit_pages(pages, inflight, submit):
+    """
+    Hand each (page_number, image_bytes) of `pages` to `submit`.
+
+    The next image is only read after `inflight` (a semaphore) grants a slot, so at most
+    its initial count of page images is held in memory; the job started by `submit` must
+    release the slot when it ends.
+    """
+    while True:
+        inflight.acquire()
+        try:
+            item = next(pages, None)
+        except Exception:
+            inflight.release()
+            raise
+        if item is None:
+            inflight.release()
+            return
+        submit(*item)
+
+
+class PageTracker:
+    """
+    Collects the per-page results of each PDF reported by worker threads.
+
+    A PDF is complete once it is closed (all its jobs are submitted) and every job has
+    reported; `on_complete(pdf_folder, results, failed)` is then called once, under the
+    tracker's lock, with `results` as {page: result}.
+    """
+
+    def __init__(self, on_complete):
+        self.on_complete = on_complete
+        self.lock = threading.Lock()
+        self.results = {}   # pdf_folder -> {page: result}
+        self.jobs = {}      # pdf_folder -> number of submitted jobs
+        self.finished = {}  # pdf_folder -> number of reported jobs
+        self.closed = set()
+        self.failed = set()
+
+    def start(self, pdf_folder):
+        """Begin a PDF; call before submitting its jobs."""
+        with self.lock:
+            self.results[pdf_folder] = {}
+            self.jobs[pdf_folder] = 0
+            self.finished[pdf_folder] = 0
+
+    def job(self, pdf_folder):
+        """Count one more submitted job; call before submitting it."""
+        with self.lock:
+            self.jobs[pdf_folder] += 1
+
+    def add(self, pdf_folder, page, result, failed=False):
+        """Report one job's result."""
+        with self.lock:
+            self.results[pdf_folder][page] = result
+            self.finished[pdf_folder] += 1
+            if failed:
+                self.failed.add(pdf_folder)
+            self._finish_if_complete(pdf_folder)
+
+    def close(self, pdf_folder, results=None, failed=False):
+        """
+        All jobs of `pdf_folder` are submitted (`failed` when scheduling stopped early).
+
+        `results` adds {page: result} that needed no job, e.g. outputs reused from the journal.
+        """
+        with self.lock:
+            self.results[pdf_folder].update(results or {})
+            self.closed.add(pdf_folder)
+            if failed:
+                self.failed.add(pdf_folder)
+            self._finish_if_complete(pdf_folder)
+
+    def _finish_if_complete(self, pdf_folder):
+        # 需在持有 lock 時呼叫
+        if pdf_folder not in self.closed or self.finished[pdf_folder] != self.jobs[pdf_folder]:
+            return
+        self.closed.discard(pdf_folder)
+        del self.jobs[pdf_folder], self.finished[pdf_folder]
+        results = self.results.pop(pdf_folder)
+        failed = pdf_folder in self.failed
+        self.failed.discard(pdf_folder)
+        self.on_complete(pdf_folder, results, failed)
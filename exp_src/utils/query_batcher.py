@@ -0,0 +1,93 @@
+import time
+import threading
+import concurrent.futures
+
+
+class QueryBatcher:
+    """
+    Packs GraphQL `Get` blocks submitted from many threads into aliased multi-query requests.
+
+    `submit(block)` queues one block such as `Tess(where: ..., hybrid: ...) { pid ... }`
+    and returns a future. A batch is sent once `batch_size` blocks are queued or `flush_latency`
+    seconds after its first block arrived; each alias of the response resolves its own future.
+    """
+
+    def __init__(self, client, batch_size=16, flush_latency=0.01, max_inflight=4):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_latency = flush_latency
+        self.condition = threading.Condition()
+        self.pending = []  # [(block, future, arrival_time)]
+        self.closed = False
+        self.requests = 0
+        self.blocks = 0
+        self.sender = concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight)
+        self.flusher = threading.Thread(target=self._run, daemon=True)
+        self.flusher.start()
+
+    def submit(self, block):
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("QueryBatcher is closed")
+            self.pending.append((block, future, time.monotonic()))
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending and self.closed:
+                    return
+                # 等到批次已滿，或最早到達的 block 已等待超過 flush latency
+                while len(self.pending) < self.batch_size and not self.closed:
+                    remaining = self.pending[0][2] + self.flush_latency - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.batch_size]
+                self.pending = self.pending[self.batch_size:]
+            self.sender.submit(self._send, batch)
+
+    def _send(self, batch):
+        aliases = [f"q{i}" for i in range(len(batch))]
+        blocks = ' '.join(f"{alias}: {block}" for alias, (block, _, _) in zip(aliases, batch))
+        try:
+            response = self.client.query.raw(f"{{ Get {{ {blocks} }} }}")
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        with self.condition:
+            self.requests += 1
+            self.blocks += len(batch)
+
+        # 錯誤以 path 對應回各自的 alias，其餘 alias 照常回傳
+        errors = {}
+        for error in response.get('errors') or []:
+            path = error.get('path') or []
+            errors.setdefault(path[1] if len(path) > 1 else None, error.get('message'))
+        data = (response.get('data') or {}).get('Get') or {}
+        for alias, (_, future, _) in zip(aliases, batch):
+            if alias in errors:
+                future.set_exception(Exception(errors[alias]))
+            elif data.get(alias) is None and errors:
+                future.set_exception(Exception(next(iter(errors.values()))))
+            else:
+                future.set_result(data.get(alias) or [])
+
+    def close(self):
+        """Send what is still queued and stop the background threads."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.flusher.join()
+        self.sender.shutdown(wait=True)
+
+    def report(self):
+        with self.condition:
+            average = self.blocks / self.requests if self.requests else 0
+            return f"Query batcher: {self.blocks} Get blocks in {self.requests} requests ({average:.1f} per request)"
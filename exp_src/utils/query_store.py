@@ -0,0 +1,68 @@
+import os
+import json
+import numpy as np
+import utils.tokenizer as tokenizer
+from utils.ai.embedding_cache import BatchEmbedder, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS
+
+QUERY_STORE_DIR = "data/cache/query_store"
+EMBEDDINGS_FILE = "embeddings.npy"
+QUERIES_FILE = "queries.json"
+
+
+class QueryStore:
+    """
+    Precomputed query artifacts for the evaluation set, keyed by qid.
+
+    Query embeddings are stored as one float32 matrix (`embeddings.npy`, opened
+    memory-mapped) and jieba-tokenized queries in `queries.json`, so every task and
+    alpha reuses them instead of embedding and tokenizing the same questions again.
+    """
+
+    def __init__(self, store_dir=QUERY_STORE_DIR):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, QUERIES_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.model = meta["model"]
+        self.dimensions = meta["dimensions"]
+        self.queries = meta["queries"]  # str(qid) -> {"row", "query", "tokens"}
+        self.embeddings = np.load(os.path.join(store_dir, EMBEDDINGS_FILE), mmap_mode="r")
+
+    @staticmethod
+    def build(questions, store_dir=QUERY_STORE_DIR, api_key=None, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS, batch_size=256):
+        """Embed (in batches) and tokenize every question once, then write the store."""
+        texts = [q["query"] for q in questions]
+        embedder = BatchEmbedder(api_key, model=model, dimensions=dimensions, batch_size=batch_size)
+        embeddings = np.asarray(embedder.embed(texts), dtype=np.float32)
+        queries = {
+            str(q["qid"]): {"row": row, "query": q["query"], "tokens": tokenizer.tokenize(q["query"])}
+            for row, q in enumerate(questions)
+        }
+
+        os.makedirs(store_dir, exist_ok=True)
+        np.save(os.path.join(store_dir, EMBEDDINGS_FILE), embeddings)
+        # queries.json 最後寫入，作為 store 完整的標記
+        tmp_path = os.path.join(store_dir, f"{QUERIES_FILE}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model": model, "dimensions": dimensions, "queries": queries}, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(store_dir, QUERIES_FILE))
+        print(embedder.report())
+
+    @classmethod
+    def load_or_build(cls, questions, store_dir=QUERY_STORE_DIR, api_key=None, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS):
+        """Load the store, rebuilding it first when a question is missing or its text changed."""
+        if os.path.exists(os.path.join(store_dir, QUERIES_FILE)):
+            store = cls(store_dir)
+            if store.model == model and store.dimensions == dimensions and all(store.has(q["qid"], q["query"]) for q in questions):
+                return store
+        cls.build(questions, store_dir, api_key, model, dimensions)
+        return cls(store_dir)
+
+    def has(self, qid, query):
+        entry = self.queries.get(str(qid))
+        return entry is not None and entry["query"] == query
+
+    def vector(self, qid):
+        return self.embeddings[self.queries[str(qid)]["row"]]
+
+    def tokens(self, qid):
+        return self.queries[str(qid)]["tokens"]